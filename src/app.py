@@ -1,18 +1,41 @@
-from flask import Flask, request, send_from_directory, redirect, url_for, render_template, render_template_string, session, abort, make_response
+from flask import Flask, Blueprint, current_app, g, request, send_from_directory, send_file, redirect, url_for, render_template, render_template_string, session, abort, make_response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import logging
-import markdown
 import uuid
 import random
 import string
 import io
 import base64
+import threading
+import gzip
+import shutil
+import mimetypes
+import hashlib
+import sqlite3
+import time
+import functools
+import cProfile
+import sys
+import atexit
+import tempfile
+import zlib
+import bisect
+import heapq
+import itertools
+import collections
+import unicodedata
+from urllib.parse import quote
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时回退到gzip
+    zstandard = None
 
 
 def load_dotenv(env_file: str = '.env') -> None:
@@ -35,52 +58,218 @@ def load_dotenv(env_file: str = '.env') -> None:
             os.environ.setdefault(key, value)
 
 
-load_dotenv()
-
 STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
 
-# 配置日志
-log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
-logging.basicConfig(level=getattr(logging, log_level, logging.INFO))
 logger = logging.getLogger(__name__)
-logger.info('Serving static files from: %s', STATIC_FOLDER)
 
-app = Flask(__name__, static_folder=STATIC_FOLDER, static_url_path='/static')
-# 从环境变量读取密钥，如果没有设置则使用默认值
-secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')  # 在生产环境中应该使用更安全的密钥
-app.secret_key = secret_key
-logger.debug("Secret key loaded: %s", secret_key[:10] + "..." if len(secret_key) > 10 else secret_key)  # 只显示前10个字符以保护安全
+bp = Blueprint('main', __name__)
+
+
+# 应用配置，创建应用时从环境变量读取
+class Config:
+    def __init__(self):
+        # 从环境变量读取密钥，如果没有设置则使用默认值
+        self.SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-here')  # 在生产环境中应该使用更安全的密钥
+        self.UPLOAD_FOLDER = os.environ.get(
+            'UPLOAD_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'uploads'))
+        # 管理员凭据
+        self.ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
+        self.ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'password123')
+        # 最大存储容量（字节），默认1GB
+        self.MAX_STORAGE_BYTES = int(os.environ.get('MAX_STORAGE_BYTES', 1024 * 1024 * 1024))  # 1GB
+        # 每隔多少个版本保存一次完整快照，其余版本只保存增量
+        self.PERSONAL_CLIPBOARD_SNAPSHOT_INTERVAL = max(1, int(os.environ.get('PERSONAL_CLIPBOARD_SNAPSHOT_INTERVAL', 20)))
+        # 历史版本保留策略：最多保留的版本数和天数，0表示不限制；最早保留的版本会改存为完整快照
+        self.PERSONAL_CLIPBOARD_HISTORY_MAX_VERSIONS = int(os.environ.get('PERSONAL_CLIPBOARD_HISTORY_MAX_VERSIONS', 200))
+        self.PERSONAL_CLIPBOARD_HISTORY_MAX_DAYS = float(os.environ.get('PERSONAL_CLIPBOARD_HISTORY_MAX_DAYS', 30))
+        # 落盘压缩配置：off（默认）、gzip、zstd、auto（优先zstd，未安装时使用gzip）
+        self.STORAGE_COMPRESSION = os.environ.get('STORAGE_COMPRESSION', 'off').lower()
+        # 小于该大小的文件不压缩
+        self.STORAGE_COMPRESSION_MIN_BYTES = int(os.environ.get('STORAGE_COMPRESSION_MIN_BYTES', 4096))
+        # 采样压缩比（压缩后/压缩前）不高于该值时才压缩存储
+        self.STORAGE_COMPRESSION_MAX_RATIO = float(os.environ.get('STORAGE_COMPRESSION_MAX_RATIO', 0.8))
+        # 上传后处理任务队列数据库，默认放在上传目录下
+        self.JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB')
+        # 每个进程的后台任务线程数，0表示不处理任务（仅入队）
+        self.JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+        # 最大尝试次数
+        self.JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+        # 重试退避基数（秒），第n次失败后等待 base * 2^(n-1) 秒
+        self.JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 5))
+        # 任务租约（秒）：进程被回收时正在执行的任务在租约到期后会被重新领取
+        self.JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+        # 存储配额预留账本数据库，默认放在上传目录下
+        self.QUOTA_LEDGER_DB = os.environ.get('QUOTA_LEDGER_DB')
+        # 预留超时（秒）：上传进程异常退出时，未提交的预留在超时后自动释放
+        self.QUOTA_RESERVATION_TTL = int(os.environ.get('QUOTA_RESERVATION_TTL', 3600))
+        # 存储占用账本与上传目录的核对周期（秒），用于纠正在应用之外增删的文件
+        self.STORAGE_RECONCILE_INTERVAL = int(os.environ.get('STORAGE_RECONCILE_INTERVAL', 3600))
+        # 每个用户的默认存储配额（字节），0表示不限制（仍受总容量限制）
+        self.USER_QUOTA_BYTES = int(os.environ.get('USER_QUOTA_BYTES', 0))
+        # 单独指定的用户配额，格式：alice=1073741824,bob=536870912
+        self.USER_QUOTAS = parse_user_quotas(os.environ.get('USER_QUOTAS', ''))
+        # 带宽限制（字节/秒），0表示不限制：全局上限和每个客户端（登录用户或IP）的上限
+        self.BANDWIDTH_GLOBAL_BPS = int(os.environ.get('BANDWIDTH_GLOBAL_BPS', 0))
+        self.BANDWIDTH_CLIENT_BPS = int(os.environ.get('BANDWIDTH_CLIENT_BPS', 0))
+        # 令牌桶容量（字节），允许的瞬时突发量
+        self.BANDWIDTH_BURST_BYTES = int(os.environ.get('BANDWIDTH_BURST_BYTES', 256 * 1024))
+        # 大于该大小的上传/下载视为大文件传输，才会被限速
+        self.BANDWIDTH_BULK_THRESHOLD = int(os.environ.get('BANDWIDTH_BULK_THRESHOLD', 1024 * 1024))
+        # 有普通页面请求进行中时，为其保留的全局带宽比例
+        self.BANDWIDTH_INTERACTIVE_SHARE = float(os.environ.get('BANDWIDTH_INTERACTIVE_SHARE', 0.5))
+        # 慢请求分析：默认关闭，关闭时不安装中间件
+        self.PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'False').lower() == 'true'
+        # 首字节时间超过该值（毫秒）的请求记录调用栈采样；流式响应的发送时间不计入
+        self.PROFILER_SLOW_MS = int(os.environ.get('PROFILER_SLOW_MS', 1000))
+        # 随机抽取该比例（0~1）的请求做完整的cProfile分析
+        self.PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+        # 最多保留的分析记录数，超出后删除最旧的
+        self.PROFILER_MAX_ENTRIES = int(os.environ.get('PROFILER_MAX_ENTRIES', 50))
+        # 分析记录存储目录，默认放在上传目录下
+        self.PROFILER_DIR = os.environ.get('PROFILER_DIR')
+        # 剪贴板NDJSON导入时每批提交的记录数
+        self.CLIPBOARD_IMPORT_BATCH_SIZE = max(1, int(os.environ.get('CLIPBOARD_IMPORT_BATCH_SIZE', 500)))
+        # 导入时单行记录的最大字节数，超出的行记为失败并跳过
+        self.CLIPBOARD_IMPORT_MAX_LINE_BYTES = int(os.environ.get('CLIPBOARD_IMPORT_MAX_LINE_BYTES', 8 * 1024 * 1024))
+        # 冷热分层存储：默认关闭，开启后按访问统计把冷文件移到次级存储，访问时自动取回
+        self.TIERING_ENABLED = os.environ.get('TIERING_ENABLED', 'False').lower() == 'true'
+        # 次级存储后端：local（本地压缩目录）或 s3（对象存储）
+        self.TIER_BACKEND = os.environ.get('TIER_BACKEND', 'local').lower()
+        # 本地次级存储目录，默认为上传目录旁的 <上传目录>_cold
+        self.TIER_LOCAL_DIR = os.environ.get('TIER_LOCAL_DIR')
+        # S3存储桶、键前缀和自定义端点（如MinIO），凭据使用boto3的标准环境变量
+        self.TIER_S3_BUCKET = os.environ.get('TIER_S3_BUCKET', '')
+        self.TIER_S3_PREFIX = os.environ.get('TIER_S3_PREFIX', 'cold/')
+        self.TIER_S3_ENDPOINT_URL = os.environ.get('TIER_S3_ENDPOINT_URL') or None
+        # 超过该天数未被访问（且上传时间也早于此）的文件视为冷文件
+        self.TIER_COLD_AFTER_DAYS = float(os.environ.get('TIER_COLD_AFTER_DAYS', 30))
+        # 小于该大小的文件不移动
+        self.TIER_MIN_BYTES = int(os.environ.get('TIER_MIN_BYTES', 1024 * 1024))
+        # 本地存储占用超过总容量的该比例时，额外按最近最少访问的顺序移出文件，0表示不启用
+        self.TIER_HOT_MAX_RATIO = float(os.environ.get('TIER_HOT_MAX_RATIO', 0.8))
+        # 分层整理的执行间隔（秒）
+        self.TIER_SWEEP_INTERVAL = int(os.environ.get('TIER_SWEEP_INTERVAL', 3600))
+        # 访问统计在内存中缓冲，每隔多少秒批量写入一次
+        self.ACCESS_STATS_FLUSH_INTERVAL = float(os.environ.get('ACCESS_STATS_FLUSH_INTERVAL', 30))
+        # 分层目录数据库（访问统计、冷文件目录、取回耗时），默认放在上传目录下
+        self.TIERING_DB = os.environ.get('TIERING_DB')
+        # 文件名搜索索引的变更日志数据库，默认放在上传目录下
+        self.FILE_INDEX_DB = os.environ.get('FILE_INDEX_DB')
+        # 每隔多少秒全量扫描一次上传目录，发现不经过本应用的文件改动
+        self.FILE_INDEX_RESCAN_INTERVAL = int(os.environ.get('FILE_INDEX_RESCAN_INTERVAL', 300))
+
+
+# 解析用户配额配置
+def parse_user_quotas(value):
+    quotas = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        username, quota = item.split('=', 1)
+        if username.strip():
+            quotas[username.strip()] = int(quota.strip())
+    return quotas
+
+
+# 配置日志
+def configure_logging():
+    log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=getattr(logging, log_level, logging.INFO))
+
+
+# 创建应用。config为字典或配置对象，用于覆盖环境变量中的配置。
+# 这里只做轻量的初始化，剪贴板文件、任务队列、验证码字体和密码哈希都在首次使用时才初始化，
+# 因此可以配合gunicorn --preload在主进程中创建一次，由各worker共享。
+def create_app(config=None):
+    load_dotenv()
+    configure_logging()
+
+    app = Flask(__name__, static_folder=STATIC_FOLDER, static_url_path='/static')
+    app.config.from_object(Config())
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
+    logger.info('Serving static files from: %s', STATIC_FOLDER)
+    secret_key = app.config['SECRET_KEY']
+    logger.debug("Secret key loaded: %s", secret_key[:10] + "..." if len(secret_key) > 10 else secret_key)  # 只显示前10个字符以保护安全
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_folder, exist_ok=True)
+    # 剪贴板数据存储文件路径
+    app.config.setdefault('CLIPBOARD_FILE', os.path.join(upload_folder, 'clipboard.json'))
+    # 个人剪贴板数据存储文件路径
+    app.config.setdefault('PERSONAL_CLIPBOARD_FILE', os.path.join(upload_folder, 'personal_clipboard.json'))
+    # 个人剪贴板历史版本存储目录（每个剪贴板一个按行追加的JSON文件）
+    app.config.setdefault('PERSONAL_CLIPBOARD_HISTORY_DIR', os.path.join(upload_folder, '.personal_clipboard_history'))
+    # 压缩存储元数据文件：记录哪些文件以何种编码存储及其原始大小
+    app.config.setdefault('STORAGE_META_FILE', os.path.join(upload_folder, '.storage_meta.json'))
+    if not app.config['JOB_QUEUE_DB']:
+        app.config['JOB_QUEUE_DB'] = os.path.join(upload_folder, '.jobs.db')
+    if not app.config['QUOTA_LEDGER_DB']:
+        app.config['QUOTA_LEDGER_DB'] = os.path.join(upload_folder, '.quota.db')
+    if not app.config['TIERING_DB']:
+        app.config['TIERING_DB'] = os.path.join(upload_folder, '.tiering.db')
+    if not app.config['FILE_INDEX_DB']:
+        app.config['FILE_INDEX_DB'] = os.path.join(upload_folder, '.file_index.db')
+    if not app.config['TIER_LOCAL_DIR']:
+        app.config['TIER_LOCAL_DIR'] = os.path.abspath(upload_folder).rstrip(os.sep) + '_cold'
+
+    if app.config['TIERING_ENABLED']:
+        tracker = AccessTracker(app.config['TIERING_DB'], app.config['ACCESS_STATS_FLUSH_INTERVAL'])
+        # 进程退出时写入尚未落盘的访问统计
+        atexit.register(tracker.flush)
+        app.extensions['access_tracker'] = tracker
+
+    app.extensions['bandwidth_shaper'] = BandwidthShaper(
+        global_rate=app.config['BANDWIDTH_GLOBAL_BPS'],
+        client_rate=app.config['BANDWIDTH_CLIENT_BPS'],
+        burst=app.config['BANDWIDTH_BURST_BYTES'],
+        interactive_share=app.config['BANDWIDTH_INTERACTIVE_SHARE']
+    )
 
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    if app.config['PROFILER_ENABLED']:
+        if not app.config['PROFILER_DIR']:
+            app.config['PROFILER_DIR'] = os.path.join(upload_folder, '.profiles')
+        profiler = RequestProfiler(
+            app.wsgi_app,
+            profile_dir=app.config['PROFILER_DIR'],
+            slow_ms=app.config['PROFILER_SLOW_MS'],
+            sample_rate=app.config['PROFILER_SAMPLE_RATE'],
+            max_entries=app.config['PROFILER_MAX_ENTRIES']
+        )
+        app.wsgi_app = profiler
+        app.extensions['request_profiler'] = profiler
+
+    app.register_blueprint(bp)
+    return app
 
-# 从环境变量读取配置，如果没有设置则使用默认值
-users = {}
-admin_username = os.environ.get('ADMIN_USERNAME', 'admin')
-admin_password = os.environ.get('ADMIN_PASSWORD', 'password123')
-users[admin_username] = generate_password_hash(admin_password)
-logger.debug("Initialized user: %s", admin_username)
 
-# 最大存储容量（字节），默认1GB
-MAX_STORAGE_BYTES = int(os.environ.get('MAX_STORAGE_BYTES', 1024 * 1024 * 1024))  # 1GB
+# 获取用户表，首次登录时才计算管理员密码哈希
+def get_users():
+    users = current_app.extensions.get('users')
+    if users is None:
+        admin_username = current_app.config['ADMIN_USERNAME']
+        users = {admin_username: generate_password_hash(current_app.config['ADMIN_PASSWORD'])}
+        current_app.extensions['users'] = users
+        logger.debug("Initialized user: %s", admin_username)
+    return users
 
-# 剪贴板数据存储文件路径
-CLIPBOARD_FILE = os.path.join(UPLOAD_FOLDER, 'clipboard.json')
-# 个人剪贴板数据存储文件路径
-PERSONAL_CLIPBOARD_FILE = os.path.join(UPLOAD_FOLDER, 'personal_clipboard.json')
+# 剪贴板读改写锁，避免同一进程内并发保存互相覆盖
+clipboard_lock = threading.Lock()
+personal_clipboard_lock = threading.Lock()
 
 # 初始化剪贴板数据存储
 def init_clipboard_storage():
-    if not os.path.exists(CLIPBOARD_FILE):
-        with open(CLIPBOARD_FILE, 'w', encoding='utf-8') as f:
+    if not os.path.exists(current_app.config['CLIPBOARD_FILE']):
+        with open(current_app.config['CLIPBOARD_FILE'], 'w', encoding='utf-8') as f:
             json.dump({"clipboard_items": []}, f)
 
 # 初始化个人剪贴板数据存储
 def init_personal_clipboard_storage():
-    if not os.path.exists(PERSONAL_CLIPBOARD_FILE):
-        with open(PERSONAL_CLIPBOARD_FILE, 'w', encoding='utf-8') as f:
-            json.dump({"personal_clipboards": []}, f)
+    if not os.path.exists(current_app.config['PERSONAL_CLIPBOARD_FILE']):
+        with open(current_app.config['PERSONAL_CLIPBOARD_FILE'], 'w', encoding='utf-8') as f:
+            json.dump({"personal_clipboards": [], "newlines_normalized": True}, f)
 
 # 生成验证码
 def generate_captcha_text(length=4):
@@ -88,27 +277,38 @@ def generate_captcha_text(length=4):
     characters = string.digits  # 只使用数字
     return ''.join(random.choice(characters) for _ in range(length))
 
-# 生成验证码图片
-def generate_captcha_image(text):
-    """生成验证码图片"""
-    width = 120
-    height = 40
+# 验证码字体大小
+CAPTCHA_FONT_SIZE = 24
 
-    # 创建图片
-    image = Image.new('RGB', (width, height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(image)
+# 加载验证码字体（首次生成验证码时才导入Pillow并加载字体，之后复用）
+@functools.lru_cache(maxsize=1)
+def get_captcha_font():
+    from PIL import ImageFont
 
     try:
         # 尝试使用DejaVu字体，减小字体大小
-        font_size = 24
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", CAPTCHA_FONT_SIZE)
     except:
         try:
             # 尝试使用Liberation字体
-            font = ImageFont.truetype("/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", font_size)
+            return ImageFont.truetype("/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", CAPTCHA_FONT_SIZE)
         except:
             # 使用默认字体
-            font = ImageFont.load_default()
+            return ImageFont.load_default()
+
+# 生成验证码图片
+def generate_captcha_image(text):
+    """生成验证码图片"""
+    from PIL import Image, ImageDraw
+
+    width = 120
+    height = 40
+    font_size = CAPTCHA_FONT_SIZE
+
+    # 创建图片
+    image = Image.new('RGB', (width, height), color=(255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = get_captcha_font()
 
     # 计算字符位置，使4个数字均匀分布并最大化利用空间
     char_width = width // len(text)
@@ -133,169 +333,2953 @@ def generate_captcha_image(text):
         y = random.randint(0, height)
         draw.point((x, y), fill=(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
 
-    # 将图片转换为base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    # 将图片转换为base64
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
+# 验证验证码
+def validate_captcha(user_input, session_captcha):
+    """验证用户输入的验证码是否正确"""
+    if not session_captcha or not user_input:
+        return False
+    return user_input.upper() == session_captcha.upper()
+
+# 加载剪贴板数据
+def load_clipboard_data():
+    try:
+        with open(current_app.config['CLIPBOARD_FILE'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # 如果文件不存在或解析失败，初始化文件
+        init_clipboard_storage()
+        with open(current_app.config['CLIPBOARD_FILE'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+# 原子写入JSON文件：先写临时文件再替换，正在流式导出的读者不会读到写了一半的文件
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# 保存剪贴板数据
+def save_clipboard_data(data):
+    write_json_atomic(current_app.config['CLIPBOARD_FILE'], data)
+
+# 加载个人剪贴板数据
+def load_personal_clipboard_data():
+    try:
+        with open(current_app.config['PERSONAL_CLIPBOARD_FILE'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # 如果文件不存在或解析失败，初始化文件
+        init_personal_clipboard_storage()
+        with open(current_app.config['PERSONAL_CLIPBOARD_FILE'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+# 保存个人剪贴板数据
+def save_personal_clipboard_data(data):
+    write_json_atomic(current_app.config['PERSONAL_CLIPBOARD_FILE'], data)
+
+# 逐条读取JSON文件中顶层数组的元素，不把整个文件读入内存
+def iter_json_array_items(path, key, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    start_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        eof = False
+        # 定位数组开始位置
+        while True:
+            match = start_pattern.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,')
+            if buffer.startswith(']'):
+                return
+            if buffer:
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError:
+                    # 元素不完整，继续读取
+                    if eof:
+                        raise
+                else:
+                    yield item
+                    buffer = buffer[end:]
+                    continue
+            elif eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+
+# 个人剪贴板版本冲突（基础版本已过期）
+class PersonalClipboardConflict(Exception):
+    def __init__(self, clipboard):
+        super().__init__("个人剪贴板已被修改，请基于最新版本重新提交")
+        self.clipboard = clipboard
+
+# 统一换行符为LF：浏览器textarea.value总是使用LF，而表单提交的内容使用CRLF，
+# 两者不一致会使基于字符位置的增量落在错误的位置
+def normalize_newlines(text):
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+# 统一增量中插入文本的换行符，格式不合法的操作原样保留，由apply_text_delta报错
+def normalize_delta_ops(ops):
+    if not isinstance(ops, list):
+        return ops
+    return [
+        dict(op, ins=normalize_newlines(op["ins"]))
+        if isinstance(op, dict) and isinstance(op.get("ins"), str) else op
+        for op in ops
+    ]
+
+# 计算两段文本之间的增量（公共前后缀之外的部分作为一次替换）
+def compute_text_delta(old, new):
+    if old == new:
+        return []
+    prefix = 0
+    max_prefix = min(len(old), len(new))
+    while prefix < max_prefix and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    max_suffix = min(len(old), len(new)) - prefix
+    while suffix < max_suffix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return [{
+        "pos": prefix,
+        "del": len(old) - prefix - suffix,
+        "ins": new[prefix:len(new) - suffix]
+    }]
+
+# 将增量应用到文本上，ops按顺序执行，位置基于前一步的结果
+def apply_text_delta(text, ops):
+    if not isinstance(ops, list):
+        raise ValueError("增量格式错误：ops必须是列表")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError("增量格式错误：每个操作必须是对象")
+        pos = op.get("pos")
+        delete_count = op.get("del", 0)
+        insert_text = op.get("ins", "")
+        if (not isinstance(pos, int) or not isinstance(delete_count, int)
+                or isinstance(pos, bool) or isinstance(delete_count, bool)
+                or not isinstance(insert_text, str)):
+            raise ValueError("增量格式错误：pos/del必须是整数，ins必须是字符串")
+        if pos < 0 or delete_count < 0 or pos + delete_count > len(text):
+            raise ValueError("增量位置超出内容范围")
+        text = text[:pos] + insert_text + text[pos + delete_count:]
+    return text
+
+# 历史版本列表每页显示的版本数
+PERSONAL_CLIPBOARD_VERSIONS_PAGE_SIZE = 20
+# 历史记录行的开头（版本号、时间和类型），列出版本时不需要解析快照内容
+PERSONAL_CLIPBOARD_HISTORY_PREFIX = re.compile(r'\{"version": (\d+), "created_at": "([^"]*)", "(snapshot|ops)"')
+
+# 个人剪贴板历史文件路径
+def get_personal_clipboard_history_path(clipboard_id):
+    return os.path.join(current_app.config['PERSONAL_CLIPBOARD_HISTORY_DIR'], f"{clipboard_id}.jsonl")
+
+# 追加一条历史记录：周期性保存完整快照，其余只保存增量
+def append_personal_clipboard_history(clipboard_id, version, content, ops=None):
+    os.makedirs(current_app.config['PERSONAL_CLIPBOARD_HISTORY_DIR'], exist_ok=True)
+    history_path = get_personal_clipboard_history_path(clipboard_id)
+    snapshot_interval = current_app.config['PERSONAL_CLIPBOARD_SNAPSHOT_INTERVAL']
+    entry = {"version": version, "created_at": datetime.now().isoformat()}
+    existing = os.path.exists(history_path)
+    if ops is None or not existing or version % snapshot_interval == 0:
+        entry["snapshot"] = content
+    else:
+        entry["ops"] = ops
+    with open(history_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    # 每写一个快照检查一次保留策略，清理的开销分摊到多个版本上
+    if existing and "snapshot" in entry:
+        prune_personal_clipboard_history(clipboard_id)
+
+# 按保留策略清理历史记录（调用方需持有personal_clipboard_lock）：删除超出版本数或天数的旧版本，
+# 最新版本总是保留；保留的第一个版本如果是增量，先还原出内容改存为快照，后续增量仍可依次应用
+def prune_personal_clipboard_history(clipboard_id):
+    max_versions = current_app.config['PERSONAL_CLIPBOARD_HISTORY_MAX_VERSIONS']
+    max_days = current_app.config['PERSONAL_CLIPBOARD_HISTORY_MAX_DAYS']
+    if max_versions <= 0 and max_days <= 0:
+        return
+    entries = load_personal_clipboard_history(clipboard_id)
+    keep_from = max(0, len(entries) - max_versions) if max_versions > 0 else 0
+    if max_days > 0:
+        cutoff = (datetime.now() - timedelta(days=max_days)).isoformat()
+        while keep_from < len(entries) - 1 and entries[keep_from].get("created_at", "") < cutoff:
+            keep_from += 1
+    if keep_from == 0:
+        return
+    
+    base = entries[keep_from]
+    if "snapshot" not in base:
+        content = None
+        for entry in entries[:keep_from + 1]:
+            if "snapshot" in entry:
+                content = entry["snapshot"]
+            elif content is not None:
+                content = apply_text_delta(content, entry["ops"])
+        if content is None:
+            # 没有可用的快照作为基础，保留原样
+            return
+        base = {"version": base["version"], "created_at": base.get("created_at", ""), "snapshot": content}
+    
+    history_path = get_personal_clipboard_history_path(clipboard_id)
+    tmp_path = f"{history_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in [base] + entries[keep_from + 1:]:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, history_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# 加载个人剪贴板的历史记录
+def load_personal_clipboard_history(clipboard_id):
+    entries = []
+    try:
+        with open(get_personal_clipboard_history_path(clipboard_id), 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 跳过写入中断造成的残缺行
+                    logger.warning("Skipping corrupt history line for clipboard %s", clipboard_id)
+    except FileNotFoundError:
+        pass
+    return entries
+
+# 校验并生成个人剪贴板（不保存），名称或内容不合法时抛出ValueError
+def prepare_personal_clipboard(name, content, creator):
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("个人剪贴板名称不能为空")
+    if not isinstance(content, str):
+        raise ValueError("个人剪贴板内容必须是字符串")
+    now = datetime.now().isoformat()
+    return {
+        "id": str(uuid.uuid4()),
+        "name": name,
+        "content": normalize_newlines(content),
+        "creator": creator,
+        "version": 1,
+        "created_at": now,
+        "updated_at": now
+    }
+
+# 创建个人剪贴板
+def create_personal_clipboard(name, content, creator):
+    # 对于单用户场景，创建者就是所有者
+    clipboard = prepare_personal_clipboard(name, content, creator)
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        data["personal_clipboards"].append(clipboard)
+        save_personal_clipboard_data(data)
+        append_personal_clipboard_history(clipboard["id"], 1, clipboard["content"])
+    return clipboard
+
+# 获取用户创建的个人剪贴板
+def get_user_personal_clipboards(username):
+    data = load_personal_clipboard_data()
+    return [clipboard for clipboard in data["personal_clipboards"] 
+            if clipboard["creator"] == username]
+
+# 获取特定个人剪贴板
+def get_personal_clipboard(clipboard_id, username):
+    data = load_personal_clipboard_data()
+    for clipboard in data["personal_clipboards"]:
+        if clipboard["id"] == clipboard_id and clipboard["creator"] == username:
+            return clipboard
+    return None
+
+# 提交个人剪贴板的新版本（调用方需持有personal_clipboard_lock）
+def commit_personal_clipboard_change(data, clipboard, new_content, ops):
+    current_version = clipboard.get("version", 1)
+    # 旧数据没有历史记录时，先补一份当前版本的快照作为增量基础
+    if not os.path.exists(get_personal_clipboard_history_path(clipboard["id"])):
+        append_personal_clipboard_history(clipboard["id"], current_version, clipboard["content"])
+    clipboard["content"] = new_content
+    clipboard["version"] = current_version + 1
+    clipboard["updated_at"] = datetime.now().isoformat()
+    save_personal_clipboard_data(data)
+    append_personal_clipboard_history(clipboard["id"], clipboard["version"], new_content, ops)
+    return clipboard
+
+# 更新个人剪贴板内容
+def update_personal_clipboard(clipboard_id, content, username, base_version=None):
+    content = normalize_newlines(content)
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        for clipboard in data["personal_clipboards"]:
+            if clipboard["id"] == clipboard_id and clipboard["creator"] == username:
+                if base_version is not None and base_version != clipboard.get("version", 1):
+                    raise PersonalClipboardConflict(clipboard)
+                ops = compute_text_delta(clipboard["content"], content)
+                if not ops:
+                    return clipboard
+                return commit_personal_clipboard_change(data, clipboard, content, ops)
+    return None
+
+# 以增量方式更新个人剪贴板，基础版本不一致时抛出冲突
+def patch_personal_clipboard(clipboard_id, base_version, ops, username):
+    ops = normalize_delta_ops(ops)
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        for clipboard in data["personal_clipboards"]:
+            if clipboard["id"] == clipboard_id and clipboard["creator"] == username:
+                if base_version != clipboard.get("version", 1):
+                    raise PersonalClipboardConflict(clipboard)
+                new_content = apply_text_delta(clipboard["content"], ops)
+                if new_content == clipboard["content"]:
+                    return clipboard
+                return commit_personal_clipboard_change(data, clipboard, new_content, ops)
+    return None
+
+# 读取历史记录中各版本的版本号、时间和类型，只匹配行首，不解析快照和增量内容
+def load_personal_clipboard_history_meta(clipboard_id):
+    versions = []
+    try:
+        with open(get_personal_clipboard_history_path(clipboard_id), 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip()
+                # 写入中断的残缺行没有结尾的括号
+                if not line.endswith('}'):
+                    continue
+                match = PERSONAL_CLIPBOARD_HISTORY_PREFIX.match(line)
+                if match:
+                    versions.append({
+                        "version": int(match.group(1)),
+                        "created_at": match.group(2),
+                        "type": "snapshot" if match.group(3) == "snapshot" else "delta"
+                    })
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                versions.append({
+                    "version": entry["version"],
+                    "created_at": entry.get("created_at", ""),
+                    "type": "snapshot" if "snapshot" in entry else "delta"
+                })
+    except FileNotFoundError:
+        pass
+    return versions
+
+# 获取个人剪贴板的版本列表（按版本号倒序分页），返回当前页的版本和版本总数
+def get_personal_clipboard_versions(clipboard_id, username, page=1, page_size=PERSONAL_CLIPBOARD_VERSIONS_PAGE_SIZE):
+    if not get_personal_clipboard(clipboard_id, username):
+        return None, 0
+    versions = load_personal_clipboard_history_meta(clipboard_id)
+    versions.sort(key=lambda x: x["version"], reverse=True)
+    start = (max(1, page) - 1) * page_size
+    return versions[start:start + page_size], len(versions)
+
+# 还原个人剪贴板的指定历史版本内容：从最近的快照开始依次应用增量
+def get_personal_clipboard_version(clipboard_id, version, username):
+    if not get_personal_clipboard(clipboard_id, username):
+        return None
+    content = None
+    for entry in load_personal_clipboard_history(clipboard_id):
+        if entry["version"] > version:
+            break
+        if "snapshot" in entry:
+            content = entry["snapshot"]
+        elif content is not None:
+            content = apply_text_delta(content, entry["ops"])
+        if entry["version"] == version:
+            return content
+    return None
+
+# 将个人剪贴板恢复到指定历史版本（作为一个新版本保存）
+def restore_personal_clipboard_version(clipboard_id, version, username):
+    content = get_personal_clipboard_version(clipboard_id, version, username)
+    if content is None:
+        return None
+    return update_personal_clipboard(clipboard_id, content, username)
+
+# 删除个人剪贴板
+def delete_personal_clipboard(clipboard_id, username):
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        # 用户可以删除自己创建的剪贴板
+        remaining = [
+            clipboard for clipboard in data["personal_clipboards"] 
+            if not (clipboard["id"] == clipboard_id and clipboard["creator"] == username)
+        ]
+        deleted = len(remaining) != len(data["personal_clipboards"])
+        data["personal_clipboards"] = remaining
+        save_personal_clipboard_data(data)
+        # 同时删除历史版本
+        if deleted:
+            remove_personal_clipboard_history(clipboard_id)
+
+# 一次性迁移：把已保存内容中的CRLF统一为LF。内容有变化的剪贴板保存为新版本（完整快照），
+# 使旧版本号上的编辑会话收到冲突并重新加载，而不是把增量应用到错位的内容上
+def migrate_personal_clipboard_newlines():
+    if current_app.extensions.get('personal_clipboard_newlines_migrated'):
+        return
+    with personal_clipboard_lock:
+        if current_app.extensions.get('personal_clipboard_newlines_migrated'):
+            return
+        if os.path.exists(current_app.config['PERSONAL_CLIPBOARD_FILE']):
+            data = load_personal_clipboard_data()
+            if not data.get("newlines_normalized"):
+                now = datetime.now().isoformat()
+                migrated = 0
+                for clipboard in data["personal_clipboards"]:
+                    content = clipboard.get("content")
+                    if not isinstance(content, str) or '\r' not in content:
+                        continue
+                    current_version = clipboard.get("version", 1)
+                    if not os.path.exists(get_personal_clipboard_history_path(clipboard["id"])):
+                        append_personal_clipboard_history(clipboard["id"], current_version, content)
+                    clipboard["content"] = normalize_newlines(content)
+                    clipboard["version"] = current_version + 1
+                    clipboard["updated_at"] = now
+                    append_personal_clipboard_history(clipboard["id"], clipboard["version"], clipboard["content"])
+                    migrated += 1
+                data["newlines_normalized"] = True
+                save_personal_clipboard_data(data)
+                if migrated:
+                    logger.info("Normalized line endings of %d personal clipboards", migrated)
+        current_app.extensions['personal_clipboard_newlines_migrated'] = True
+
+# 删除个人剪贴板的历史文件
+def remove_personal_clipboard_history(clipboard_id):
+    history_path = get_personal_clipboard_history_path(clipboard_id)
+    if os.path.exists(history_path):
+        os.remove(history_path)
+
+# 校验并生成剪贴板项目（不保存），内容不合法时抛出ValueError
+def prepare_clipboard_item(content, owner, is_public=False):
+    if not isinstance(content, str):
+        raise ValueError("剪贴板内容必须是字符串")
+    # 限制剪贴板内容大小（最大1MB）
+    if len(content.encode('utf-8')) > 1024 * 1024:
+        raise ValueError("剪贴板内容不得超过1MB")
+    
+    # 过滤潜在的危险内容
+    # 移除可能的脚本标签（基础过滤）
+    filtered_content = re.sub(r'<script[^>]*>.*?</script>', '', content, flags=re.IGNORECASE | re.DOTALL)
+    
+    return {
+        "id": str(uuid.uuid4()),
+        "content": filtered_content,
+        "owner": owner,
+        "created_at": datetime.now().isoformat(),
+        "is_public": bool(is_public)
+    }
+
+# 添加剪贴板项目
+def add_clipboard_item(content, owner, is_public=False):
+    item = prepare_clipboard_item(content, owner, is_public)
+    with clipboard_lock:
+        data = load_clipboard_data()
+        data["clipboard_items"].append(item)
+        save_clipboard_data(data)
+    return item
+
+# 获取用户的所有剪贴板项目
+def get_user_clipboard_items(username):
+    data = load_clipboard_data()
+    # 返回用户自己的项目和公开项目
+    return [item for item in data["clipboard_items"] 
+            if item["owner"] == username or item["is_public"]]
+
+# 获取特定的剪贴板项目
+def get_clipboard_item(item_id, username):
+    data = load_clipboard_data()
+    for item in data["clipboard_items"]:
+        # 用户可以访问自己的项目或公开项目
+        if item["id"] == item_id and (item["owner"] == username or item["is_public"]):
+            return item
+    return None
+
+# 删除剪贴板项目
+def delete_clipboard_item(item_id, username):
+    with clipboard_lock:
+        data = load_clipboard_data()
+        # 用户只能删除自己的项目
+        data["clipboard_items"] = [item for item in data["clipboard_items"] 
+                                  if not (item["id"] == item_id and item["owner"] == username)]
+        save_clipboard_data(data)
+
+# 批量添加和删除剪贴板项目：逐条校验，所有有效记录在一次读改写中提交
+def bulk_update_clipboard_items(adds, delete_ids, username):
+    result = {"added": [], "deleted": [], "errors": []}
+    new_items = []
+    for index, record in enumerate(adds):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("记录必须是JSON对象")
+            item = prepare_clipboard_item(record.get("content"), username, record.get("is_public", False))
+        except ValueError as e:
+            result["errors"].append({"op": "add", "index": index, "error": str(e)})
+            continue
+        new_items.append(item)
+        result["added"].append({"index": index, "id": item["id"]})
+    
+    with clipboard_lock:
+        data = load_clipboard_data()
+        # 用户只能删除自己的项目
+        own_ids = {item["id"] for item in data["clipboard_items"] if item["owner"] == username}
+        to_delete = set()
+        for index, item_id in enumerate(delete_ids):
+            if isinstance(item_id, str) and item_id in own_ids:
+                to_delete.add(item_id)
+                result["deleted"].append({"index": index, "id": item_id})
+            else:
+                result["errors"].append({"op": "delete", "index": index, "error": "剪贴板项目未找到或无权删除"})
+        if new_items or to_delete:
+            data["clipboard_items"] = [item for item in data["clipboard_items"] if item["id"] not in to_delete]
+            data["clipboard_items"].extend(new_items)
+            save_clipboard_data(data)
+    return result
+
+# 批量添加和删除个人剪贴板：逐条校验，所有有效记录在一次读改写中提交
+def bulk_update_personal_clipboards(adds, delete_ids, username):
+    result = {"added": [], "deleted": [], "errors": []}
+    new_clipboards = []
+    for index, record in enumerate(adds):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("记录必须是JSON对象")
+            clipboard = prepare_personal_clipboard(record.get("name"), record.get("content", ""), username)
+        except ValueError as e:
+            result["errors"].append({"op": "add", "index": index, "error": str(e)})
+            continue
+        new_clipboards.append(clipboard)
+        result["added"].append({"index": index, "id": clipboard["id"]})
+    
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        own_ids = {clipboard["id"] for clipboard in data["personal_clipboards"] if clipboard["creator"] == username}
+        to_delete = set()
+        for index, clipboard_id in enumerate(delete_ids):
+            if isinstance(clipboard_id, str) and clipboard_id in own_ids:
+                to_delete.add(clipboard_id)
+                result["deleted"].append({"index": index, "id": clipboard_id})
+            else:
+                result["errors"].append({"op": "delete", "index": index, "error": "个人剪贴板未找到或无权删除"})
+        if new_clipboards or to_delete:
+            data["personal_clipboards"] = [
+                clipboard for clipboard in data["personal_clipboards"] if clipboard["id"] not in to_delete
+            ]
+            data["personal_clipboards"].extend(new_clipboards)
+            save_personal_clipboard_data(data)
+            for clipboard in new_clipboards:
+                append_personal_clipboard_history(clipboard["id"], 1, clipboard["content"])
+            for clipboard_id in to_delete:
+                remove_personal_clipboard_history(clipboard_id)
+    return result
+
+# 从NDJSON记录生成剪贴板项目，保留导出文件中的创建时间
+def clipboard_item_from_record(record, username):
+    item = prepare_clipboard_item(record.get("content"), username, record.get("is_public", False))
+    created_at = record.get("created_at")
+    if isinstance(created_at, str):
+        try:
+            item["created_at"] = datetime.fromisoformat(created_at).isoformat()
+        except ValueError:
+            pass
+    return item
+
+# 提交一批导入的剪贴板项目
+def commit_imported_clipboard_items(items):
+    with clipboard_lock:
+        data = load_clipboard_data()
+        data["clipboard_items"].extend(items)
+        save_clipboard_data(data)
+
+# 提交一批导入的个人剪贴板
+def commit_imported_personal_clipboards(clipboards):
+    with personal_clipboard_lock:
+        data = load_personal_clipboard_data()
+        data["personal_clipboards"].extend(clipboards)
+        save_personal_clipboard_data(data)
+        for clipboard in clipboards:
+            append_personal_clipboard_history(clipboard["id"], 1, clipboard["content"])
+
+# 逐行读取请求体，返回(行号, 内容)；超过最大长度的行返回None并跳过剩余部分
+def iter_ndjson_lines(stream, max_line_bytes):
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_line_bytes and not line.endswith(b"\n"):
+            while True:
+                rest = stream.readline(64 * 1024)
+                if not rest or rest.endswith(b"\n"):
+                    break
+            yield line_number, None
+            continue
+        yield line_number, line
+
+# 流式导入NDJSON记录：逐条校验并输出每条记录的结果，按批提交，内存占用与导入总量无关
+def import_ndjson_records(stream, build_record, commit_batch):
+    config = current_app.config
+    batch, pending = [], []
+    imported = failed = 0
+    for line_number, line in iter_ndjson_lines(stream, config['CLIPBOARD_IMPORT_MAX_LINE_BYTES']):
+        if line is None:
+            failed += 1
+            yield {"line": line_number, "success": False, "error": "记录超过最大行长度"}
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("记录必须是JSON对象")
+            item = build_record(record)
+        except ValueError as e:
+            failed += 1
+            yield {"line": line_number, "success": False, "error": str(e)}
+            continue
+        batch.append(item)
+        pending.append({"line": line_number, "success": True, "id": item["id"]})
+        if len(batch) >= config['CLIPBOARD_IMPORT_BATCH_SIZE']:
+            commit_batch(batch)
+            imported += len(batch)
+            yield from pending
+            batch, pending = [], []
+    if batch:
+        commit_batch(batch)
+        imported += len(batch)
+        yield from pending
+    yield {"summary": True, "imported": imported, "failed": failed}
+
+# 将记录序列输出为NDJSON流式响应
+def ndjson_response(records, filename=None):
+    def generate():
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+    response = current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if filename:
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+# 登录页面模板
+# 允许的文件扩展名
+ALLOWED_EXTENSIONS = {
+    'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 
+    'ppt', 'pptx', 'zip', 'rar', '7z', 'tar', 'gz', 'mp3', 'mp4', 'avi', 'mov',
+    'mpg', 'mpeg', 'wmv', 'flv', 'webm', 'mkv', 'wav', 'ogg', 'ogv', 'm4a',
+    'py', 'js', 'java', 'c', 'cpp', 'html', 'css', 'php', 'go', 'rb', 'pl', 'sh', 'sql',
+    'md', 'yaml', 'yml', 'json', 'xml', 'conf', 'config', 'ini', 'cfg', 'env', 'env.example'
+}
+
+# 可预览的文本文件扩展名
+TEXT_PREVIEW_EXTENSIONS = {'txt', 'md', 'log', 'csv', 'json', 'xml', 'html', 'css', 'js', 'py', 'java', 'c', 'cpp', 'sql', 'yaml', 'yml', 'ini', 'cfg', 'conf', 'env', 'sh', 'pl', 'rb', 'go', 'php'}
+
+# 可预览的图片文件扩展名
+IMAGE_PREVIEW_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+
+# 压缩包文件扩展名
+ARCHIVE_EXTENSIONS = {'zip', 'rar', '7z', 'tar', 'gz'}
+
+# 可压缩存储的文件扩展名（文本类文件压缩率高）
+COMPRESSIBLE_EXTENSIONS = TEXT_PREVIEW_EXTENSIONS | {'config'}
+# 采样大小
+STORAGE_COMPRESSION_SAMPLE_BYTES = 64 * 1024
+
+# 压缩存储元数据读改写锁
+storage_meta_lock = threading.Lock()
+
+# 获取当前生效的落盘压缩编码
+def get_storage_encoding():
+    compression = current_app.config['STORAGE_COMPRESSION']
+    if compression == 'zstd':
+        if zstandard is None:
+            logger.warning("STORAGE_COMPRESSION=zstd but zstandard is not installed, falling back to gzip")
+            return 'gzip'
+        return 'zstd'
+    if compression == 'gzip':
+        return 'gzip'
+    if compression == 'auto':
+        return 'zstd' if zstandard is not None else 'gzip'
+    return None
+
+# 加载压缩存储元数据
+def load_storage_meta():
+    try:
+        with open(current_app.config['STORAGE_META_FILE'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}}
+
+# 保存压缩存储元数据（先写临时文件再替换，避免写入中断损坏）
+def save_storage_meta(meta):
+    meta_file = current_app.config['STORAGE_META_FILE']
+    tmp_path = meta_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_file)
+
+# 删除文件的压缩存储记录（文件已删除或移到次级存储）
+def clear_stored_file_encoding(filename):
+    with storage_meta_lock:
+        meta = load_storage_meta()
+        if meta["files"].pop(filename, None) is not None:
+            save_storage_meta(meta)
+
+# 按文件的实际版本解析压缩存储记录。记录带有它所描述的文件版本，以及替换前文件的记录：
+# 版本一致时使用本记录，不一致说明文件还没被替换（或替换前进程中断），使用替换前的记录。
+# 没有版本的旧记录直接使用。返回None表示原样存储
+def resolve_storage_info(entry, stat):
+    if not entry or "version" not in entry:
+        return entry
+    info = entry if format_file_version(stat) == entry["version"] else entry.get("previous")
+    return info if info and info.get("encoding") else None
+
+# 获取文件的压缩存储信息，未压缩返回None；stat为已打开文件的状态时，结果与该文件的内容一致
+def get_stored_file_encoding(filename, stat=None, meta=None):
+    entry = (meta or load_storage_meta())["files"].get(filename)
+    if not entry or "version" not in entry:
+        return entry
+    if stat is None:
+        try:
+            stat = os.stat(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        except FileNotFoundError:
+            return None
+    return resolve_storage_info(entry, stat)
+
+# 用临时文件原子替换存储的文件并更新压缩存储记录，encoding为None表示原样存储，返回占用的磁盘字节数。
+# 先记录新版本的编码（同时保留替换前文件的记录）再替换，替换后再去掉旧记录，
+# 任何时刻读到的记录都能和磁盘上的文件对应，进程在中间中断也不会按错误的编码读取
+def replace_stored_file(tmp_path, filepath, encoding, logical_size):
+    filename = os.path.basename(filepath)
+    stat = os.stat(tmp_path)
+    version = format_file_version(stat)
+    with storage_meta_lock:
+        meta = load_storage_meta()
+        # 原样存储且没有旧记录时不需要记录
+        recorded = encoding is not None or filename in meta["files"]
+        if recorded:
+            try:
+                previous = get_stored_file_encoding(filename, os.stat(filepath), meta)
+            except FileNotFoundError:
+                previous = None
+            meta["files"][filename] = {
+                "encoding": encoding,
+                "size": logical_size,
+                "stored_size": stat.st_size,
+                "version": version,
+                "previous": previous and {key: previous[key] for key in ("encoding", "size", "stored_size")}
+            }
+            save_storage_meta(meta)
+    os.replace(tmp_path, filepath)
+    if not recorded:
+        return stat.st_size
+    with storage_meta_lock:
+        meta = load_storage_meta()
+        entry = meta["files"].get(filename)
+        if entry is not None and entry.get("version") == version:
+            if encoding:
+                entry.pop("previous", None)
+            else:
+                del meta["files"][filename]
+            save_storage_meta(meta)
+    return stat.st_size
+
+# 压缩一段数据，用于采样估算压缩比
+def compress_bytes(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+# 根据文件类型和采样压缩比判断是否压缩存储
+def choose_upload_encoding(filename, stream, file_size):
+    encoding = get_storage_encoding()
+    if not encoding or file_size < current_app.config['STORAGE_COMPRESSION_MIN_BYTES']:
+        return None
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return None
+    sample = stream.read(STORAGE_COMPRESSION_SAMPLE_BYTES)
+    stream.seek(0)
+    if not sample:
+        return None
+    ratio = len(compress_bytes(sample, encoding)) / len(sample)
+    return encoding if ratio <= current_app.config['STORAGE_COMPRESSION_MAX_RATIO'] else None
+
+# 保存上传的文件，必要时压缩存储，返回实际占用的磁盘字节数。
+# 先写临时文件再原子替换，读者不会读到写了一半的文件或与编码记录不符的内容
+def save_uploaded_file(file, filepath, file_size):
+    filename = os.path.basename(filepath)
+    encoding = choose_upload_encoding(filename, file.stream, file_size)
+    tmp_path = os.path.join(os.path.dirname(filepath), f".upload-{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'wb') as out:
+            write_encoded_stream(file.stream, out, encoding)
+        stored_size = replace_stored_file(tmp_path, filepath, encoding, file_size)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if encoding:
+        logger.debug("Stored %s with %s: %d -> %d bytes", filename, encoding, file_size, stored_size)
+    return stored_size
+
+# 打开存储的文件（不解压），返回(文件对象, 文件状态, 压缩存储信息)，压缩存储信息与打开的文件版本一致
+def open_stored_file_raw(filepath):
+    f = open(filepath, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+        return f, stat, get_stored_file_encoding(os.path.basename(filepath), stat)
+    except Exception:
+        f.close()
+        raise
+
+# 以二进制流方式打开存储的文件，压缩存储的文件会透明解压
+def open_stored_file(filepath):
+    f, stat, info = open_stored_file_raw(filepath)
+    if not info:
+        return f
+    if info["encoding"] == 'zstd' and zstandard is None:
+        f.close()
+        raise RuntimeError("文件以zstd压缩存储，但服务器未安装zstandard")
+    return open_decoded_stream(f, info["encoding"])
+
+# 分块读取解压后的文件内容。不能把解压文件对象直接交给send_file：GzipFile.fileno()返回底层压缩文件的描述符，
+# gunicorn的wsgi.file_wrapper会因此走sendfile路径，发送失败
+def iter_file_chunks(fileobj, chunk_size=64 * 1024):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+# 获取文件的原始（逻辑）大小
+def get_logical_file_size(filename, stat, meta=None):
+    info = get_stored_file_encoding(filename, stat, meta)
+    return info["size"] if info else stat.st_size
+
+# 删除存储的文件及其压缩元数据（包括次级存储中的冷副本）
+def delete_stored_file(filename):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    deleted = False
+    if os.path.exists(filepath) and os.path.isfile(filepath):
+        os.remove(filepath)
+        clear_stored_file_encoding(filename)
+        deleted = True
+    if forget_tiered_file(filename):
+        deleted = True
+    if not deleted:
+        return False
+    record_file_index_change('remove', filename)
+    delete_file_jobs(filename)
+    forget_file_owner(filename)
+    return True
+
+# 当前进程中已初始化过的SQLite数据库
+initialized_sqlite_dbs = set()
+
+# 打开SQLite连接（每次操作使用独立连接，避免跨线程/跨进程共享），首次使用时才建表
+def connect_sqlite(db_path, init_schema):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if db_path not in initialized_sqlite_dbs:
+        init_schema(conn)
+        initialized_sqlite_dbs.add(db_path)
+    return conn
+
+# 存储配额超限
+class QuotaExceeded(Exception):
+    pass
+
+# 初始化配额账本：reservations记录进行中的上传预留，file_owners记录已提交文件的归属和大小，
+# hot_files记录上传目录中每个文件实际占用的字节数（总容量按它计算，不必在预留时遍历目录）
+def init_quota_ledger(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        has_hot_files = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hot_files'"
+        ).fetchone() is not None
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS hot_files (
+                filename TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL
+            )
+        """)
+        # 首次建立账本时按现有文件初始化
+        if not has_hot_files:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hot_files (filename, bytes) VALUES (?, ?)",
+                scan_stored_file_sizes(current_app.config['UPLOAD_FOLDER']).items()
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reservations (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS file_owners (
+            filename TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            bytes INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_username ON reservations(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_owners_username ON file_owners(username)")
+
+# 获取配额账本数据库连接
+def get_quota_db():
+    return connect_sqlite(current_app.config['QUOTA_LEDGER_DB'], init_quota_ledger)
+
+# 获取用户的存储配额，0表示不限制
+def get_user_quota(username):
+    return current_app.config['USER_QUOTAS'].get(username, current_app.config['USER_QUOTA_BYTES'])
+
+# 判断上传目录中的条目是否为内部文件：隐藏文件和目录（数据库、元数据、分析记录等）以及剪贴板数据文件。
+# 它们不经过上传预留，不计入配额，也不会被移到次级存储
+def is_internal_storage_file(name):
+    if name.startswith('.'):
+        return True
+    return name in (os.path.basename(current_app.config['CLIPBOARD_FILE']),
+                    os.path.basename(current_app.config['PERSONAL_CLIPBOARD_FILE']))
+
+# 统计上传目录中各文件占用的字节数，跳过内部文件
+def scan_stored_file_sizes(directory):
+    sizes = {}
+    if not os.path.isdir(directory):
+        return sizes
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if is_internal_storage_file(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+            except FileNotFoundError:
+                pass
+    return sizes
+
+# 获取上传目录中已提交文件占用的总字节数
+def get_used_storage_bytes(conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_quota_db()
+    try:
+        return conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM hot_files").fetchone()[0]
+    finally:
+        if own_conn:
+            conn.close()
+
+# 记录文件在上传目录中的占用字节数（如从次级存储取回后）
+def record_hot_file(filename, size):
+    conn = get_quota_db()
+    try:
+        conn.execute("INSERT OR REPLACE INTO hot_files (filename, bytes) VALUES (?, ?)", (filename, size))
+    finally:
+        conn.close()
+
+# 获取用户已提交文件和进行中预留占用的字节数
+def get_user_usage(conn, username):
+    committed = conn.execute(
+        "SELECT COALESCE(SUM(bytes), 0) FROM file_owners WHERE username = ?", (username,)
+    ).fetchone()[0]
+    reserved = conn.execute(
+        "SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE username = ? AND expires_at >= ?",
+        (username, time.time())
+    ).fetchone()[0]
+    return committed + reserved
+
+# 为即将写入的文件预留存储空间。检查和预留在同一个写事务中完成，
+# 多个线程或进程并发上传时不会同时通过检查而超出总容量或个人配额。
+# 已占用空间取自账本而不是遍历目录：正在写入的文件只以预留计入，不会重复计算；
+# 覆盖同名文件时，旧文件的占用在提交后会被替换，因此不计入
+def reserve_storage(username, filename, size):
+    now = time.time()
+    conn = get_quota_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # 释放超时未提交的预留
+        conn.execute("DELETE FROM reservations WHERE expires_at < ?", (now,))
+        reserved = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM reservations").fetchone()[0]
+        replaced = conn.execute("SELECT bytes FROM hot_files WHERE filename = ?", (filename,)).fetchone()
+        used = get_used_storage_bytes(conn) - (replaced[0] if replaced else 0)
+        if used + reserved + size > current_app.config['MAX_STORAGE_BYTES']:
+            raise QuotaExceeded('上传此文件将超出存储限制，请删除一些文件后再试。')
+        
+        user_quota = get_user_quota(username)
+        if user_quota > 0:
+            owned = conn.execute(
+                "SELECT bytes FROM file_owners WHERE filename = ? AND username = ?", (filename, username)
+            ).fetchone()
+            user_usage = get_user_usage(conn, username) - (owned[0] if owned else 0)
+            if user_usage + size > user_quota:
+                raise QuotaExceeded(
+                    f'上传此文件将超出您的存储配额（已用 {format_file_size(user_usage)}，配额 {format_file_size(user_quota)}），请删除一些文件后再试。'
+                )
+        
+        reservation_id = str(uuid.uuid4())
+        conn.execute(
+            "INSERT INTO reservations (id, username, filename, bytes, expires_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (reservation_id, username, filename, size, now + current_app.config['QUOTA_RESERVATION_TTL'],
+             datetime.now().isoformat())
+        )
+        conn.execute("COMMIT")
+        return reservation_id
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# 文件写入完成后提交预留：释放预留，同时记录文件归属和实际占用大小
+def commit_reservation(reservation_id, username, filename, stored_size):
+    conn = get_quota_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+        conn.execute(
+            "INSERT OR REPLACE INTO file_owners (filename, username, bytes) VALUES (?, ?, ?)",
+            (filename, username, stored_size)
+        )
+        conn.execute("INSERT OR REPLACE INTO hot_files (filename, bytes) VALUES (?, ?)", (filename, stored_size))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# 上传失败时释放预留
+def release_reservation(reservation_id):
+    conn = get_quota_db()
+    try:
+        conn.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+    finally:
+        conn.close()
+
+# 文件删除后移除归属和占用记录
+def forget_file_owner(filename):
+    conn = get_quota_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM file_owners WHERE filename = ?", (filename,))
+        conn.execute("DELETE FROM hot_files WHERE filename = ?", (filename,))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# 按周期入队账本核对任务；任务键包含时间段编号，多个进程同一周期只会入队一次
+def maybe_schedule_storage_reconcile():
+    app = current_app._get_current_object()
+    period = int(time.time() // max(1, app.config['STORAGE_RECONCILE_INTERVAL']))
+    if app.extensions.get('storage_reconcile_period') == period:
+        return
+    app.extensions['storage_reconcile_period'] = period
+    try:
+        enqueue_job('storage_reconcile', f"storage_reconcile:{period}")
+    except sqlite3.Error:
+        logger.exception("Failed to schedule storage ledger reconcile")
+
+# 获取用户配额使用情况，未设置配额时返回None
+def get_user_quota_info(username):
+    user_quota = get_user_quota(username)
+    if user_quota <= 0:
+        return None
+    conn = get_quota_db()
+    try:
+        user_usage = get_user_usage(conn, username)
+    finally:
+        conn.close()
+    return {
+        'user_used_storage': format_file_size(user_usage),
+        'user_quota': format_file_size(user_quota),
+        'user_usage_percentage': round((user_usage / user_quota) * 100, 2)
+    }
+
+# 上传后处理任务队列（SQLite持久化，worker回收或重启后任务不丢失）
+# 空闲时轮询间隔（秒）
+JOB_POLL_INTERVAL = 2.0
+
+# 任务类型 -> 处理函数
+JOB_HANDLERS = {}
+# 上传完成后需要执行的任务类型
+POST_UPLOAD_JOB_TYPES = ['hash', 'metadata']
+
+job_wakeup_event = threading.Event()
+job_workers_lock = threading.Lock()
+
+# 注册任务处理函数
+def job_handler(job_type):
+    def decorator(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return decorator
+
+# 获取任务队列数据库连接
+def get_job_db():
+    return connect_sqlite(current_app.config['JOB_QUEUE_DB'], init_job_queue)
+
+# 初始化任务队列数据库
+def init_job_queue(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT NOT NULL UNIQUE,
+            job_type TEXT NOT NULL,
+            filename TEXT,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after REAL NOT NULL,
+            locked_until REAL,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_filename ON jobs(filename)")
+
+# 入队任务；job_key相同的任务只会入队一次
+def enqueue_job(job_type, job_key, filename=None, payload=None, max_attempts=None):
+    now = datetime.now().isoformat()
+    conn = get_job_db()
+    try:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO jobs (job_key, job_type, filename, payload, max_attempts, run_after, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_key, job_type, filename, json.dumps(payload or {}), max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+             time.time(), now, now)
+        )
+        created = cursor.rowcount > 0
+    finally:
+        conn.close()
+    if created:
+        ensure_job_workers_started()
+        job_wakeup_event.set()
+    return created
+
+# 为刚上传的文件入队后处理任务，任务键包含修改时间和大小，重复上传同一内容不会重复处理
+def enqueue_post_upload_jobs(filename):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        # 文件在入队前已被删除，无需后处理
+        return
+    for job_type in POST_UPLOAD_JOB_TYPES:
+        enqueue_job(job_type, f"{job_type}:{filename}:{stat.st_mtime_ns}:{stat.st_size}", filename)
+
+# 删除文件相关的任务记录
+def delete_file_jobs(filename):
+    conn = get_job_db()
+    try:
+        conn.execute("DELETE FROM jobs WHERE filename = ? AND status != 'running'", (filename,))
+    finally:
+        conn.close()
+
+# 领取一个可执行的任务（包括租约已过期的运行中任务）
+def claim_job():
+    now = time.time()
+    conn = get_job_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE (status = 'pending' AND run_after <= ?) "
+            "OR (status = 'running' AND locked_until < ?) ORDER BY run_after LIMIT 1",
+            (now, now)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ? WHERE id = ?",
+            (now + current_app.config['JOB_LEASE_SECONDS'], datetime.now().isoformat(), row["id"])
+        )
+        conn.execute("COMMIT")
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# 记录任务执行结果：失败时按指数退避重试，超过最大次数标记为失败
+def finish_job(job, result=None, error=None, retryable=True):
+    now = datetime.now().isoformat()
+    conn = get_job_db()
+    try:
+        if error is None:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, locked_until = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result or {}, ensure_ascii=False), now, job["id"])
+            )
+        elif retryable and job["attempts"] < job["max_attempts"]:
+            delay = current_app.config['JOB_RETRY_BACKOFF'] * (2 ** (job["attempts"] - 1))
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', run_after = ?, error = ?, locked_until = NULL, updated_at = ? WHERE id = ?",
+                (time.time() + delay, error, now, job["id"])
+            )
+        else:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, locked_until = NULL, updated_at = ? WHERE id = ?",
+                (error, now, job["id"])
+            )
+    finally:
+        conn.close()
+
+# 执行一个任务
+def run_job(job):
+    handler = JOB_HANDLERS.get(job["job_type"])
+    if handler is None:
+        finish_job(job, error=f"未知的任务类型：{job['job_type']}", retryable=False)
+        return
+    if job["attempts"] > job["max_attempts"]:
+        # 多次在执行中被中断（如进程被回收）的任务不再重试
+        finish_job(job, error="任务多次执行中断，已放弃", retryable=False)
+        return
+    try:
+        result = handler(job["filename"], json.loads(job["payload"]))
+    except FileNotFoundError:
+        finish_job(job, error="文件不存在", retryable=False)
+    except Exception as e:
+        logger.exception("Job %s (%s) failed", job["id"], job["job_key"])
+        finish_job(job, error=str(e))
+    else:
+        finish_job(job, result=result)
+
+# 后台任务线程主循环
+def job_worker_loop(app):
+    with app.app_context():
+        while True:
+            try:
+                job = claim_job()
+            except sqlite3.Error:
+                logger.exception("Failed to claim job")
+                job = None
+            if job is None:
+                job_wakeup_event.wait(JOB_POLL_INTERVAL)
+                job_wakeup_event.clear()
+                continue
+            try:
+                run_job(job)
+            except Exception:
+                # 记录结果失败（如数据库长时间被锁）时不能让线程退出，否则该进程不会再启动任务线程；
+                # 任务保持running状态，租约到期后会被重新领取
+                logger.exception("Failed to run job %s (%s)", job["id"], job["job_key"])
+
+# 按需启动后台任务线程；gunicorn --preload时线程不会在主进程中启动，
+# fork出的每个worker在处理第一个请求时启动自己的线程
+def ensure_job_workers_started():
+    app = current_app._get_current_object()
+    worker_count = app.config['JOB_WORKERS']
+    if worker_count <= 0 or app.extensions.get('job_workers_pid') == os.getpid():
+        return
+    with job_workers_lock:
+        if app.extensions.get('job_workers_pid') == os.getpid():
+            return
+        for i in range(worker_count):
+            threading.Thread(target=job_worker_loop, args=(app,), name=f"job-worker-{i}", daemon=True).start()
+        app.extensions['job_workers_pid'] = os.getpid()
+        logger.info("Started %d job worker(s) in process %d", worker_count, os.getpid())
+
+# 获取文件的后处理状态
+def get_file_job_status(filename):
+    conn = get_job_db()
+    try:
+        rows = conn.execute(
+            "SELECT job_type, status, attempts, result, error, updated_at FROM jobs "
+            "WHERE filename = ? ORDER BY id", (filename,)
+        ).fetchall()
+    finally:
+        conn.close()
+    # 同一类型只保留最新的任务
+    jobs = {}
+    for row in rows:
+        jobs[row["job_type"]] = {
+            "type": row["job_type"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "updated_at": row["updated_at"]
+        }
+    statuses = {job["status"] for job in jobs.values()}
+    if not jobs:
+        overall = 'none'
+    elif 'failed' in statuses:
+        overall = 'failed'
+    elif statuses == {'done'}:
+        overall = 'done'
+    elif 'running' in statuses:
+        overall = 'running'
+    else:
+        overall = 'pending'
+    return {"filename": filename, "status": overall, "jobs": list(jobs.values())}
+
+# 核对存储占用账本与上传目录，纠正在应用之外增删或修改的文件。
+# 目录扫描在事务之外进行，事务中只重新检查不一致的文件；有进行中预留的文件由上传提交维护，跳过
+@job_handler('storage_reconcile')
+def storage_reconcile_job(filename, payload):
+    upload_dir = current_app.config['UPLOAD_FOLDER']
+    sizes = scan_stored_file_sizes(upload_dir)
+    conn = get_quota_db()
+    try:
+        tracked = dict(conn.execute("SELECT filename, bytes FROM hot_files").fetchall())
+        mismatched = [name for name in sizes.keys() | tracked.keys() if sizes.get(name) != tracked.get(name)]
+        if not mismatched:
+            return {"updated": 0, "removed": 0}
+        updated, removed = 0, 0
+        conn.execute("BEGIN IMMEDIATE")
+        reserved_names = {row[0] for row in conn.execute(
+            "SELECT filename FROM reservations WHERE expires_at >= ?", (time.time(),)
+        )}
+        for name in mismatched:
+            if name in reserved_names:
+                continue
+            try:
+                size = os.stat(os.path.join(upload_dir, name)).st_size
+            except FileNotFoundError:
+                removed += conn.execute("DELETE FROM hot_files WHERE filename = ?", (name,)).rowcount
+                continue
+            conn.execute("INSERT OR REPLACE INTO hot_files (filename, bytes) VALUES (?, ?)", (name, size))
+            updated += 1
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    if updated or removed:
+        logger.info("Storage ledger reconciled: %d updated, %d removed", updated, removed)
+    return {"updated": updated, "removed": removed}
+
+# 计算文件内容的SHA-256（压缩存储的文件按原始内容计算）
+@job_handler('hash')
+def hash_file_job(filename, payload):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    digest = hashlib.sha256()
+    size = 0
+    with open_stored_file(filepath) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return {"sha256": digest.hexdigest(), "size": size}
+
+# 提取文件元数据（类型、图片尺寸、文本行数）
+@job_handler('metadata')
+def metadata_file_job(filename, payload):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    preview_type = get_preview_type(filename)
+    metadata = {
+        "mimetype": mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        "preview_type": preview_type
+    }
+    if preview_type == 'image':
+        from PIL import Image
+
+        with Image.open(filepath) as image:
+            metadata["width"], metadata["height"] = image.size
+            metadata["format"] = image.format
+    elif preview_type == 'text':
+        lines = 0
+        with open_stored_file(filepath) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                lines += chunk.count(b'\n')
+        metadata["lines"] = lines
+    return metadata
+
+# 冷热分层存储：上传目录为热存储，长期未访问的文件移到次级存储（本地压缩目录或S3），
+# 访问时自动取回。文件列表、下载和预览对分层无感知。
+# 存储压力下移出文件时，至少保留最近该秒数内访问过的文件
+TIER_PRESSURE_MIN_IDLE_SECONDS = 3600
+# 保留的取回耗时记录数
+TIER_RECALL_HISTORY = 1000
+
+# 每个文件名一把锁，避免同一进程内并发取回同一个文件
+tier_recall_locks = {}
+tier_recall_locks_lock = threading.Lock()
+
+# 初始化分层数据库：file_access为访问统计，cold_files为冷文件目录，tier_recalls为取回耗时
+def init_tiering_db(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS file_access (
+            filename TEXT PRIMARY KEY,
+            last_access REAL NOT NULL,
+            access_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cold_files (
+            filename TEXT PRIMARY KEY,
+            tier TEXT NOT NULL,
+            location TEXT NOT NULL,
+            encoding TEXT,
+            stored_size INTEGER NOT NULL,
+            logical_size INTEGER NOT NULL,
+            cold_size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            storage_meta TEXT,
+            moved_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tier_recalls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            duration_ms REAL NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+# 获取分层数据库连接
+def get_tiering_db():
+    return connect_sqlite(current_app.config['TIERING_DB'], init_tiering_db)
+
+# 分层数据库是否存在（从未启用过分层时不创建数据库）
+def tiering_db_exists():
+    return os.path.exists(current_app.config['TIERING_DB'])
+
+# 访问统计：在内存中累计，定期批量写入SQLite，不在每次请求时写文件
+class AccessTracker:
+    def __init__(self, db_path, flush_interval=30):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # 文件名 -> (访问次数, 最近访问时间)
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, filename):
+        now = time.time()
+        with self.lock:
+            count, _ = self.pending.get(filename, (0, now))
+            self.pending[filename] = (count + 1, now)
+            due = time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            conn = connect_sqlite(self.db_path, init_tiering_db)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT INTO file_access (filename, last_access, access_count) VALUES (?, ?, ?) "
+                    "ON CONFLICT(filename) DO UPDATE SET last_access = MAX(last_access, excluded.last_access), "
+                    "access_count = access_count + excluded.access_count",
+                    [(filename, last_access, count) for filename, (count, last_access) in pending.items()]
+                )
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # 访问统计只影响分层策略，写入失败时丢弃这一批
+            logger.exception("Failed to flush access stats")
+
+# 记录一次文件访问（未启用分层时不记录）
+def record_file_access(filename):
+    tracker = current_app.extensions.get('access_tracker')
+    if tracker is not None:
+        tracker.record(filename)
+
+# 以编码方式写入数据流
+def write_encoded_stream(src, dst, encoding):
+    if encoding == 'zstd':
+        with zstandard.ZstdCompressor(level=3).stream_writer(dst, closefd=False) as writer:
+            shutil.copyfileobj(src, writer)
+    elif encoding == 'gzip':
+        with gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=6, mtime=0) as writer:
+            shutil.copyfileobj(src, writer)
+    else:
+        shutil.copyfileobj(src, dst)
+
+# 以解码方式打开数据流
+def open_decoded_stream(fileobj, encoding):
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("冷文件以zstd压缩存储，但服务器未安装zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    if encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=fileobj, mode='rb')
+        # GzipFile不会关闭传入的文件对象，交给它在关闭时一起关闭（与gzip.open打开文件名时相同）
+        stream.myfileobj = fileobj
+        return stream
+    return fileobj
+
+# 本地次级存储（通常挂载在容量大、速度慢的卷上），冷文件压缩后保存
+class LocalColdTier:
+    name = 'local'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, key, src, encoding):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as dst:
+                write_encoded_stream(src, dst, encoding)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return os.path.getsize(path)
+
+    def open(self, key):
+        return open(os.path.join(self.directory, key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except FileNotFoundError:
+            pass
+
+# S3对象存储（boto3在首次使用时才导入）
+class S3ColdTier:
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', endpoint_url=None):
+        if not bucket:
+            raise RuntimeError("TIER_BACKEND=s3 需要设置 TIER_S3_BUCKET")
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def put(self, key, src, encoding):
+        # 先写入临时文件，得到压缩后的大小后再上传
+        with tempfile.TemporaryFile() as tmp:
+            write_encoded_stream(src, tmp, encoding)
+            size = tmp.tell()
+            tmp.seek(0)
+            self.client.upload_fileobj(tmp, self.bucket, self.prefix + key)
+        return size
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+# 获取指定名称的次级存储，默认为当前配置的后端
+def get_cold_tier(name=None):
+    name = name or current_app.config['TIER_BACKEND']
+    tiers = current_app.extensions.setdefault('cold_tiers', {})
+    if name not in tiers:
+        if name == 's3':
+            tiers[name] = S3ColdTier(
+                current_app.config['TIER_S3_BUCKET'],
+                current_app.config['TIER_S3_PREFIX'],
+                current_app.config['TIER_S3_ENDPOINT_URL']
+            )
+        else:
+            tiers[name] = LocalColdTier(current_app.config['TIER_LOCAL_DIR'])
+    return tiers[name]
+
+# 选择冷文件的压缩编码：已压缩存储的文件或压缩效果不好的文件原样保存
+def choose_cold_encoding(filepath, storage_info):
+    if storage_info:
+        return None
+    encoding = 'zstd' if zstandard is not None else 'gzip'
+    with open(filepath, 'rb') as f:
+        sample = f.read(STORAGE_COMPRESSION_SAMPLE_BYTES)
+    if not sample:
+        return None
+    ratio = len(compress_bytes(sample, encoding)) / len(sample)
+    return encoding if ratio <= current_app.config['STORAGE_COMPRESSION_MAX_RATIO'] else None
+
+# 获取冷文件记录，文件不在次级存储时返回None
+def get_cold_file(filename):
+    if not tiering_db_exists():
+        return None
+    conn = get_tiering_db()
+    try:
+        row = conn.execute("SELECT * FROM cold_files WHERE filename = ?", (filename,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+# 列出所有冷文件
+def list_cold_files():
+    if not tiering_db_exists():
+        return []
+    conn = get_tiering_db()
+    try:
+        rows = conn.execute("SELECT filename, logical_size, mtime FROM cold_files").fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+# 把热存储中的文件移到次级存储，返回是否移动成功
+def demote_file(filename):
+    if is_internal_storage_file(filename):
+        return False
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    storage_info = get_stored_file_encoding(filename, stat)
+    if storage_info is not None:
+        storage_info = {key: storage_info[key] for key in ("encoding", "size", "stored_size")}
+    encoding = choose_cold_encoding(filepath, storage_info)
+    tier = get_cold_tier()
+    location = uuid.uuid4().hex
+    with open(filepath, 'rb') as src:
+        cold_size = tier.put(location, src, encoding)
+    
+    # 在配额账本的写事务中完成移动：上传在写入文件前会先在账本中预留，
+    # 没有该文件名的进行中预留时不会有上传正在写入它，新的上传也要等事务结束才能开始。
+    # 热文件先改名移开，冷存储记录提交后才删除，提交失败时可以原样恢复
+    quota_conn = get_quota_db()
+    conn = get_tiering_db()
+    aside_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f".demote-{uuid.uuid4().hex}")
+    moved_aside, committed = False, False
+    previous = None
+    try:
+        quota_conn.execute("BEGIN IMMEDIATE")
+        uploading = quota_conn.execute(
+            "SELECT 1 FROM reservations WHERE filename = ? AND expires_at >= ?", (filename, time.time())
+        ).fetchone()
+        # 复制期间文件被重新上传或删除、或正在上传时放弃本次移动
+        try:
+            current = os.stat(filepath)
+        except FileNotFoundError:
+            current = None
+        if uploading or current is None or (current.st_mtime_ns, current.st_size) != (stat.st_mtime_ns, stat.st_size):
+            quota_conn.execute("ROLLBACK")
+            tier.delete(location)
+            return False
+        os.rename(filepath, aside_path)
+        moved_aside = True
+        conn.execute("BEGIN IMMEDIATE")
+        previous = conn.execute("SELECT tier, location FROM cold_files WHERE filename = ?", (filename,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO cold_files (filename, tier, location, encoding, stored_size, logical_size, "
+            "cold_size, mtime, storage_meta, moved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (filename, tier.name, location, encoding, stat.st_size,
+             storage_info["size"] if storage_info else stat.st_size, cold_size, stat.st_mtime,
+             json.dumps(storage_info) if storage_info else None, datetime.now().isoformat())
+        )
+        conn.execute("COMMIT")
+        committed = True
+        quota_conn.execute("DELETE FROM hot_files WHERE filename = ?", (filename,))
+        # 压缩存储元数据只描述热存储中的文件，取回时再恢复
+        clear_stored_file_encoding(filename)
+        quota_conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if not committed:
+            if moved_aside:
+                os.rename(aside_path, filepath)
+            tier.delete(location)
+        if quota_conn.in_transaction:
+            quota_conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+        quota_conn.close()
+        if committed:
+            os.remove(aside_path)
+    
+    if previous is not None:
+        get_cold_tier(previous["tier"]).delete(previous["location"])
+    logger.info("Moved %s to %s tier (%d -> %d bytes)", filename, tier.name, stat.st_size, cold_size)
+    return True
+
+# 从次级存储取回文件到热存储，返回是否取回（文件不在次级存储时返回False）
+def recall_file(filename):
+    with tier_recall_locks_lock:
+        lock = tier_recall_locks.setdefault(filename, threading.Lock())
+    with lock:
+        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(filepath):
+            return True
+        cold = get_cold_file(filename)
+        if cold is None:
+            return False
+        
+        started = time.perf_counter()
+        tier = get_cold_tier(cold["tier"])
+        tmp_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f".recall-{uuid.uuid4().hex}.tmp")
+        try:
+            with open_decoded_stream(tier.open(cold["location"]), cold["encoding"]) as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            # 保留原修改时间，文件列表的排序不受分层影响
+            os.utime(tmp_path, (time.time(), cold["mtime"]))
+            info = json.loads(cold["storage_meta"]) if cold["storage_meta"] else None
+            replace_stored_file(tmp_path, filepath, info and info["encoding"], cold["logical_size"])
+            record_hot_file(filename, cold["stored_size"])
+        except Exception:
+            # 其他进程已先取回并删除了冷副本
+            if os.path.exists(filepath):
+                return True
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        duration_ms = (time.perf_counter() - started) * 1000
+        
+        conn = get_tiering_db()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            removed = conn.execute(
+                "DELETE FROM cold_files WHERE filename = ? AND location = ?", (filename, cold["location"])
+            ).rowcount
+            conn.execute(
+                "INSERT INTO tier_recalls (filename, tier, bytes, duration_ms, created_at) VALUES (?, ?, ?, ?, ?)",
+                (filename, cold["tier"], cold["stored_size"], duration_ms, datetime.now().isoformat())
+            )
+            conn.execute(
+                "DELETE FROM tier_recalls WHERE id <= (SELECT MAX(id) FROM tier_recalls) - ?", (TIER_RECALL_HISTORY,)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if removed:
+            tier.delete(cold["location"])
+        logger.info("Recalled %s from %s tier in %.1f ms", filename, cold["tier"], duration_ms)
+        return True
+
+# 确保文件位于热存储：文件不存在时尝试从次级存储取回
+def ensure_hot_file(filename):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(filepath):
+        return True
+    try:
+        return recall_file(filename)
+    except Exception:
+        logger.exception("Failed to recall %s", filename)
+        return False
+
+# 文件被删除或重新上传后，清理其冷副本和访问统计
+def forget_tiered_file(filename, keep_access_stats=False):
+    if not tiering_db_exists():
+        return False
+    conn = get_tiering_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cold = conn.execute("SELECT tier, location FROM cold_files WHERE filename = ?", (filename,)).fetchone()
+        conn.execute("DELETE FROM cold_files WHERE filename = ?", (filename,))
+        if not keep_access_stats:
+            conn.execute("DELETE FROM file_access WHERE filename = ?", (filename,))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    if cold is not None:
+        get_cold_tier(cold["tier"]).delete(cold["location"])
+    return cold is not None
+
+# 按周期入队分层整理任务；任务键包含时间段编号，多个进程同一周期只会入队一次
+def maybe_schedule_tier_sweep():
+    app = current_app._get_current_object()
+    if not app.config['TIERING_ENABLED']:
+        return
+    period = int(time.time() // max(1, app.config['TIER_SWEEP_INTERVAL']))
+    if app.extensions.get('tier_sweep_period') == period:
+        return
+    app.extensions['tier_sweep_period'] = period
+    try:
+        enqueue_job('tier_sweep', f"tier_sweep:{period}")
+    except sqlite3.Error:
+        logger.exception("Failed to schedule tier sweep")
+
+# 分层整理：移出长期未访问的文件；本地存储占用过高时再按最近最少访问的顺序移出
+@job_handler('tier_sweep')
+def tier_sweep_job(filename, payload):
+    config = current_app.config
+    tracker = current_app.extensions.get('access_tracker')
+    if tracker is not None:
+        tracker.flush()
+    conn = get_tiering_db()
+    try:
+        last_access = dict(conn.execute("SELECT filename, last_access FROM file_access").fetchall())
+    finally:
+        conn.close()
+    
+    now = time.time()
+    candidates = []
+    upload_dir = config['UPLOAD_FOLDER']
+    for name in os.listdir(upload_dir):
+        if is_internal_storage_file(name):
+            continue
+        filepath = os.path.join(upload_dir, name)
+        if not os.path.isfile(filepath):
+            continue
+        stat = os.stat(filepath)
+        if stat.st_size < config['TIER_MIN_BYTES']:
+            continue
+        candidates.append((max(stat.st_mtime, last_access.get(name, 0)), name, stat.st_size))
+    candidates.sort()
+    
+    cold_before = now - config['TIER_COLD_AFTER_DAYS'] * 86400
+    used_bytes = get_used_storage_bytes()
+    target_bytes = config['MAX_STORAGE_BYTES'] * config['TIER_HOT_MAX_RATIO'] if config['TIER_HOT_MAX_RATIO'] > 0 else None
+    # 单次整理不超过任务租约的一半，剩余文件留给下一次
+    deadline = time.monotonic() + config['JOB_LEASE_SECONDS'] / 2
+    moved, moved_bytes = 0, 0
+    for last_used, name, size in candidates:
+        is_cold = last_used <= cold_before
+        under_pressure = target_bytes is not None and used_bytes > target_bytes and \
+            last_used <= now - TIER_PRESSURE_MIN_IDLE_SECONDS
+        if not (is_cold or under_pressure):
+            # 候选按最近访问时间升序排列，之后的文件更热
+            break
+        if time.monotonic() > deadline:
+            break
+        if demote_file(name):
+            moved += 1
+            moved_bytes += size
+            used_bytes -= size
+    return {"moved": moved, "moved_bytes": moved_bytes, "candidates": len(candidates)}
+
+# 计算一组数值的百分位
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# 汇总分层存储的占用情况和取回耗时
+def get_tiering_report():
+    upload_dir = current_app.config['UPLOAD_FOLDER']
+    hot_count, hot_bytes = 0, 0
+    for name in os.listdir(upload_dir):
+        filepath = os.path.join(upload_dir, name)
+        if not is_internal_storage_file(name) and os.path.isfile(filepath):
+            hot_count += 1
+            hot_bytes += os.path.getsize(filepath)
+    report = {
+        "enabled": current_app.config['TIERING_ENABLED'],
+        "backend": current_app.config['TIER_BACKEND'],
+        "hot": {"files": hot_count, "bytes": hot_bytes, "size": format_file_size(hot_bytes)},
+        "cold": [],
+        "recalls": {"count": 0}
+    }
+    if not tiering_db_exists():
+        return report
+    
+    conn = get_tiering_db()
+    try:
+        tiers = conn.execute(
+            "SELECT tier, COUNT(*) AS files, SUM(logical_size) AS logical_bytes, SUM(cold_size) AS stored_bytes "
+            "FROM cold_files GROUP BY tier"
+        ).fetchall()
+        recalls = conn.execute("SELECT bytes, duration_ms FROM tier_recalls").fetchall()
+    finally:
+        conn.close()
+    report["cold"] = [{
+        "tier": row["tier"],
+        "files": row["files"],
+        "logical_bytes": row["logical_bytes"],
+        "stored_bytes": row["stored_bytes"],
+        "size": format_file_size(row["stored_bytes"])
+    } for row in tiers]
+    durations = [row["duration_ms"] for row in recalls]
+    if durations:
+        report["recalls"] = {
+            "count": len(durations),
+            "bytes": sum(row["bytes"] for row in recalls),
+            "avg_ms": round(sum(durations) / len(durations), 1),
+            "p50_ms": round(percentile(durations, 0.5), 1),
+            "p95_ms": round(percentile(durations, 0.95), 1),
+            "max_ms": round(max(durations), 1)
+        }
+    return report
+
+# 增量上传（rsync式）：服务器提供已有文件的分块签名（adler32弱校验 + SHA-256强校验），
+# 客户端用滚动校验找出未变化的块，只上传引用块的copy操作和新增的字面数据
+# 分块大小范围，实际大小约为文件大小的平方根
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+
+# 增量数据格式错误或与服务器上的文件不匹配
+class DeltaError(ValueError):
+    pass
+
+# 基础文件在签名之后已被修改
+class DeltaConflict(Exception):
+    def __init__(self):
+        super().__init__("文件已被修改，请重新获取签名")
+
+# 选择分块大小：文件越大块越大，使签名数量和匹配粒度保持平衡
+def choose_delta_block_size(size):
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < DELTA_MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+# 文件版本标识，增量上传时用于确认基础文件未被修改
+def get_file_version(filepath):
+    return format_file_version(os.stat(filepath))
+
+# 由文件状态生成版本标识（改名替换不改变修改时间和大小）
+def format_file_version(stat):
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+# 计算已有文件的分块签名（按原始内容计算）
+def compute_file_signature(filename):
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    stat = os.stat(filepath)
+    version = format_file_version(stat)
+    size = get_logical_file_size(filename, stat)
+    block_size = choose_delta_block_size(size)
+    weak, strong = [], []
+    with open_stored_file(filepath) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            weak.append(zlib.adler32(block))
+            strong.append(hashlib.sha256(block).hexdigest())
+    return {
+        "filename": filename,
+        "version": version,
+        "size": size,
+        "block_size": block_size,
+        "weak": weak,
+        "strong": strong
+    }
+
+# 校验增量操作列表，返回(字面数据总长度, 是否仅在末尾追加)
+def validate_delta_ops(ops, block_count):
+    if not isinstance(ops, list):
+        raise DeltaError("增量格式错误：ops必须是数组")
+    literal_bytes = 0
+    for op in ops:
+        if not isinstance(op, list) or not op:
+            raise DeltaError("增量格式错误：无法识别的操作")
+        values = op[1:]
+        if not all(isinstance(v, int) and not isinstance(v, bool) and v >= 0 for v in values):
+            raise DeltaError("增量格式错误：操作参数必须是非负整数")
+        if op[0] == 'copy' and len(op) == 3:
+            if op[1] + op[2] > block_count:
+                raise DeltaError("增量引用的块超出已有文件范围")
+        elif op[0] == 'data' and len(op) == 2:
+            literal_bytes += op[1]
+        else:
+            raise DeltaError("增量格式错误：无法识别的操作")
+    # 按顺序引用了已有文件的全部块，之后只有新增数据：文件只在末尾追加了内容
+    append_only = (
+        block_count > 0 and len(ops) in (1, 2) and ops[0] == ['copy', 0, block_count]
+        and (len(ops) == 1 or ops[1][0] == 'data')
+    )
+    return literal_bytes, append_only
+
+# 从流中准确复制length个字节
+def copy_exact(src, dst, length):
+    while length > 0:
+        chunk = src.read(min(length, 1024 * 1024))
+        if not chunk:
+            raise DeltaError("增量数据长度不足")
+        dst.write(chunk)
+        length -= len(chunk)
+
+# 根据基础文件和增量操作重建新版本，写入tmp_path，返回(复制的字节数, 是否为追加)
+def reconstruct_from_delta(filename, block_size, ops, literal, tmp_path):
+    upload_dir = current_app.config['UPLOAD_FOLDER']
+    filepath = os.path.join(upload_dir, filename)
+    stat = os.stat(filepath)
+    base_size = get_logical_file_size(filename, stat)
+    block_count = (base_size + block_size - 1) // block_size
+    literal_bytes, append_only = validate_delta_ops(ops, block_count)
+    
+    compressed = get_stored_file_encoding(filename, stat) is not None
+    base_path = filepath
+    base_tmp = None
+    try:
+        if append_only:
+            # 快速路径：整体复制已有文件（未压缩时由内核完成复制），再追加新数据
+            if compressed:
+                with open_stored_file(filepath) as src, open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            else:
+                shutil.copyfile(filepath, tmp_path)
+            with open(tmp_path, 'ab') as dst:
+                copy_exact(literal, dst, literal_bytes)
+            return base_size, True
+        
+        if compressed:
+            # 压缩存储的文件不支持高效随机读取，先解压到临时文件
+            base_tmp = os.path.join(upload_dir, f".delta-base-{uuid.uuid4().hex}.tmp")
+            with open_stored_file(filepath) as src, open(base_tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            base_path = base_tmp
+        
+        copied = 0
+        with open(base_path, 'rb') as base, open(tmp_path, 'wb') as dst:
+            for op in ops:
+                if op[0] == 'copy':
+                    start = op[1] * block_size
+                    length = min((op[1] + op[2]) * block_size, base_size) - start
+                    base.seek(start)
+                    copy_exact(base, dst, length)
+                    copied += length
+                else:
+                    copy_exact(literal, dst, op[1])
+        return copied, False
+    finally:
+        if base_tmp and os.path.exists(base_tmp):
+            os.remove(base_tmp)
+
+# 将重建好的临时文件按压缩策略保存为正式文件（原子替换），返回实际占用的磁盘字节数
+def store_reconstructed_file(tmp_path, filepath, file_size):
+    filename = os.path.basename(filepath)
+    with open(tmp_path, 'rb') as f:
+        encoding = choose_upload_encoding(filename, f, file_size)
+        if encoding is None:
+            return replace_stored_file(tmp_path, filepath, None, file_size)
+        compressed_path = tmp_path + '.' + encoding
+        try:
+            with open(compressed_path, 'wb') as out:
+                write_encoded_stream(f, out, encoding)
+            return replace_stored_file(compressed_path, filepath, encoding, file_size)
+        finally:
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+
+# 应用一次增量上传：重建到临时文件，校验大小后原子替换已有文件
+def apply_delta_upload(filename, username, base_version, block_size, ops, size, literal):
+    upload_dir = current_app.config['UPLOAD_FOLDER']
+    filepath = os.path.join(upload_dir, filename)
+    if not ensure_hot_file(filename):
+        raise FileNotFoundError(filename)
+    if get_file_version(filepath) != base_version:
+        raise DeltaConflict()
+    
+    reservation_id = reserve_storage(username, filename, size)
+    tmp_path = os.path.join(upload_dir, f".delta-{uuid.uuid4().hex}.tmp")
+    try:
+        copied, append_only = reconstruct_from_delta(filename, block_size, ops, literal, tmp_path)
+        if literal.read(1):
+            raise DeltaError("字面数据长度与增量操作不一致")
+        if os.path.getsize(tmp_path) != size:
+            raise DeltaError("重建后的文件大小与预期不一致")
+        # 重建期间文件被其他上传替换时放弃，避免覆盖更新的版本
+        if get_file_version(filepath) != base_version:
+            raise DeltaConflict()
+        stored_size = store_reconstructed_file(tmp_path, filepath, size)
+    except Exception:
+        release_reservation(reservation_id)
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    commit_reservation(reservation_id, username, filename, stored_size)
+    forget_tiered_file(filename, keep_access_stats=True)
+    try:
+        enqueue_post_upload_jobs(filename)
+    except (sqlite3.Error, OSError):
+        logger.exception("Failed to enqueue post-upload jobs for %s", filename)
+    logger.info("Delta upload of %s: %d bytes reused, %d bytes received%s",
+                filename, copied, size - copied, " (append)" if append_only else "")
+    return {"copied_bytes": copied, "literal_bytes": size - copied, "append": append_only}
+
+# 文件名搜索索引：每个进程在内存中维护三元组倒排表、有序名称表（前缀查询）和扩展名索引。
+# 上传和删除写入共享的变更日志，各进程搜索前按日志增量同步，并定期全量扫描目录以发现外部改动。
+# 单次搜索最多返回的结果数
+SEARCH_MAX_LIMIT = 100
+# 变更日志保留的条数，落后更多的进程会重新全量扫描
+FILE_INDEX_CHANGE_LOG_SIZE = 10000
+# 模糊匹配时跳过过于常见的三元组（如 txt），它们几乎不区分文件
+FUZZY_MAX_POSTING_RATIO = 0.2
+# 删除的条目超过该数量且多于存活条目时重建索引，回收空间
+FILE_INDEX_COMPACT_THRESHOLD = 1000
+# 模糊匹配时只对共有三元组最多的前若干个候选计算相似度
+FUZZY_MAX_CANDIDATES = 500
+# 一两个字符的关键字在全部名称中查找子串时，最多收集的匹配数
+SHORT_TERM_MAX_MATCHES = 1000
+# 重建索引时分段排序的段大小
+FILE_INDEX_SORT_CHUNK = 4096
+# 重建索引时每添加多少个名称主动让出一次GIL
+FILE_INDEX_YIELD_EVERY = 256
+# 最少见的三元组倒排表超过该长度时，先与次少见的倒排表求交集再逐个确认子串
+FILE_INDEX_INTERSECT_MIN = 1024
+
+filename_index_lock = threading.Lock()
+
+# 字符串的三元组集合
+def name_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# 与Counter.most_common(n)的结果相同（只保留计数不小于minimum的项）。计数都是较小的整数，
+# 先统计计数的分布找到第n项的计数，只对超过该计数的项排序，候选很多时比对全部计数取前n项快
+def most_common_at_least(counts, n, minimum):
+    histogram = collections.Counter(counts.values())
+    cutoff, total = minimum, 0
+    for value in sorted(histogram, reverse=True):
+        if value < minimum:
+            break
+        total += histogram[value]
+        if total >= n:
+            cutoff = value
+            break
+    # 计数等于截止值的项按插入顺序补足，与most_common的稳定排序一致
+    top = [item for item in counts.items() if item[1] > cutoff]
+    top.sort(key=lambda item: item[1], reverse=True)
+    top.extend(itertools.islice((item for item in counts.items() if item[1] == cutoff), n - len(top)))
+    return top
+
+# 索引中名称的编号顺序：先按（小写后的）长度，再按名称
+def name_length_order(name):
+    return (len(name.lower()), name)
+
+# 解析搜索语句：ext:pdf 或 *.pdf 表示按扩展名过滤，其余部分作为文件名关键字
+def parse_search_query(query):
+    terms = []
+    extension = None
+    for token in query.strip().lower().split():
+        if token.startswith('ext:') and len(token) > 4:
+            extension = token[4:].lstrip('.')
+        elif token.startswith('*.') and len(token) > 2:
+            extension = token[2:]
+        else:
+            terms.append(token)
+    return ' '.join(terms), extension
+
+# 文件名内存索引
+class FilenameIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 最近一次全量扫描的时间和已同步到的变更日志编号
+        self.scanned_at = 0.0
+        self.last_change_id = 0
+        self.reset([])
+
+    # 用一组文件名重建索引
+    def reset(self, names):
+        with self.lock:
+            self.names = []
+            self.lowered = []
+            self.lengths = []
+            self.gram_counts = []
+            self.ids = {}
+            self.postings = {}
+            self.extensions = {}
+            self.sorted_names = []
+            self.dead = 0
+            # 按名称长度、再按名称分配编号：倒排表按编号有序，也就是按长度有序，子串匹配可以从短到长确认并提前结束；
+            # 相关度相同的结果按名称排列。分段排序后归并：一次排序全部名称会长时间占用GIL，后台重建时阻塞其他线程的搜索
+            chunks = [sorted(names[i:i + FILE_INDEX_SORT_CHUNK], key=name_length_order)
+                      for i in range(0, len(names), FILE_INDEX_SORT_CHUNK)]
+            for count, name in enumerate(heapq.merge(*chunks, key=name_length_order)):
+                self._add(name, bulk=True)
+                # 定期主动让出GIL，搜索线程从I/O返回后不必等满线程切换间隔
+                if count % FILE_INDEX_YIELD_EVERY == 0:
+                    time.sleep(0)
+            self.sorted_names.sort()
+            # 所有名称按编号拼接成一段文本，短关键字的子串查找由正则在C层完成；之后新增的名称单独逐个查找
+            self.names_text = ''.join(lowered + '\n' for lowered in self.lowered)
+            self.names_text_starts = list(itertools.accumulate((length + 1 for length in self.lengths[:-1]), initial=0))
+            # 此前的编号按长度有序，之后增量添加的名称追加在末尾
+            self.ordered_count = len(self.lowered)
+
+    def add(self, name):
+        with self.lock:
+            self._add(name)
+
+    def _add(self, name, bulk=False):
+        if name in self.ids:
+            return
+        index = len(self.names)
+        lowered = name.lower()
+        grams = name_trigrams(lowered)
+        self.names.append(name)
+        self.lowered.append(lowered)
+        self.lengths.append(len(lowered))
+        self.gram_counts.append(len(grams))
+        self.ids[name] = index
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(index)
+        if '.' in lowered:
+            self.extensions.setdefault(lowered.rsplit('.', 1)[1], []).append(index)
+        if bulk:
+            self.sorted_names.append((lowered, index))
+        else:
+            bisect.insort(self.sorted_names, (lowered, index))
+
+    def remove(self, name):
+        with self.lock:
+            index = self.ids.pop(name, None)
+            if index is None:
+                return
+            # 倒排表中的条目延迟清理，查询时跳过已删除的编号
+            self.names[index] = None
+            position = bisect.bisect_left(self.sorted_names, (self.lowered[index], index))
+            del self.sorted_names[position]
+            self.dead += 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    # 删除的条目过多时需要重建索引以回收空间（由后台重建完成）
+    def needs_compaction(self):
+        return self.dead > FILE_INDEX_COMPACT_THRESHOLD and self.dead > len(self.ids)
+
+    # 在所有名称中查找包含短关键字的编号，返回(编号列表, 是否因数量上限而截断)
+    def _scan_short_term(self, term):
+        found = []
+        last = -1
+        for match in re.finditer(re.escape(term), self.names_text):
+            i = bisect.bisect_right(self.names_text_starts, match.start()) - 1
+            if i != last:
+                found.append(i)
+                last = i
+                if len(found) >= SHORT_TERM_MAX_MATCHES:
+                    return found, True
+        lowered = self.lowered
+        found.extend(i for i in range(self.ordered_count, len(lowered)) if term in lowered[i])
+        return found, False
+
+    # 按给定顺序确认包含关键字的编号，分为单词开头和单词中间的匹配，各自最多收集needed个
+    def _collect_substring_matches(self, candidates, term, needed, accept, seen):
+        lowered = self.lowered
+        boundary, inner = [], []
+        for i in candidates:
+            name_lower = lowered[i]
+            start = name_lower.find(term)
+            if start < 0:
+                continue
+            if start and name_lower[start - 1].isalnum():
+                if len(inner) < needed and i not in seen and accept(i):
+                    inner.append(i)
+            elif i not in seen and accept(i):
+                boundary.append(i)
+                if len(boundary) >= needed:
+                    break
+        return boundary, inner
+
+    # 搜索文件名，返回(结果列表, 是否还有更多结果)。排序依次为：前缀匹配、单词开头匹配、
+    # 其他子串匹配（较短的文件名优先），子串结果不足时补充三元组相似的模糊匹配
+    def search(self, query, limit=20, fuzzy=True):
+        term, extension = parse_search_query(query)
+        if not term and not extension:
+            return [], False
+        with self.lock:
+            names = self.names
+            lowered = self.lowered
+            allowed = None
+            if extension is not None:
+                allowed = {i for i in self.extensions.get(extension, ()) if names[i] is not None}
+            
+            def accept(i):
+                return names[i] is not None and (allowed is None or i in allowed)
+            
+            if not term:
+                ordered = heapq.nsmallest(limit + 1, allowed, key=lowered.__getitem__)
+                return [{"name": names[i], "match": "extension"} for i in ordered[:limit]], len(ordered) > limit
+            
+            results = []
+            seen = set()
+            # 前缀匹配：在有序名称表中二分查找
+            position = bisect.bisect_left(self.sorted_names, (term,))
+            for name_lower, i in itertools.islice(self.sorted_names, position, None):
+                if not name_lower.startswith(term):
+                    break
+                if accept(i):
+                    results.append({"name": names[i], "match": "prefix"})
+                    seen.add(i)
+                    if len(results) > limit:
+                        return results[:limit], True
+            
+            # 子串匹配：候选取自最少见的三元组倒排表（较长时先与次少见的两个倒排表求交集），
+            # 一两个字符的关键字没有三元组可用，在扩展名过滤后的范围或全部名称中查找（匹配数有上限）
+            capped = False
+            if len(term) >= 3:
+                grams = name_trigrams(term)
+                postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+                candidates = postings[0]
+                for other in postings[1:3]:
+                    if len(candidates) <= FILE_INDEX_INTERSECT_MIN:
+                        break
+                    common = set(other)
+                    narrowed = [i for i in candidates if i in common]
+                    # 三元组总是一起出现时交集不会明显缩小范围，不再继续
+                    done = len(narrowed) * 2 > len(candidates)
+                    candidates = narrowed
+                    if done:
+                        break
+            elif allowed is not None:
+                candidates = sorted(allowed)
+            else:
+                candidates, capped = self._scan_short_term(term)
+            
+            # 按长度从短到长确认，单词开头的匹配优先于单词中间的匹配。候选按编号有序，
+            # 排序后建立的部分也就按长度有序，找够单词开头的匹配即可停止；之后增量添加的名称单独排序后合并
+            needed = limit + 1 - len(results)
+            split = bisect.bisect_left(candidates, self.ordered_count)
+            boundary, inner = self._collect_substring_matches(
+                itertools.islice(candidates, split), term, needed, accept, seen)
+            if split < len(candidates):
+                extra_boundary, extra_inner = self._collect_substring_matches(
+                    sorted(candidates[split:], key=self.lengths.__getitem__), term, needed, accept, seen)
+                boundary = heapq.nsmallest(needed, boundary + extra_boundary, key=self.lengths.__getitem__)
+                inner = heapq.nsmallest(needed, inner + extra_inner, key=self.lengths.__getitem__)
+            for i in (boundary + inner)[:needed]:
+                results.append({"name": names[i], "match": "substring"})
+                seen.add(i)
+            if len(results) > limit or capped:
+                return results[:limit], True
+            
+            # 模糊匹配：统计与查询共有的三元组数量，按相似度排序
+            if fuzzy and len(term) >= 3:
+                max_posting = max(1, int(len(self.ids) * FUZZY_MAX_POSTING_RATIO))
+                useful = [p for p in postings if len(p) <= max_posting] or postings
+                counts = collections.Counter()
+                for posting in useful:
+                    counts.update(posting)
+                threshold = max(1, int(len(grams) * 0.3 + 0.5))
+                scored = [
+                    (shared / (len(grams) + self.gram_counts[i] - shared), i)
+                    for i, shared in most_common_at_least(counts, FUZZY_MAX_CANDIDATES, threshold)
+                    if i not in seen and accept(i)
+                ]
+                remaining = limit + 1 - len(results)
+                for score, i in heapq.nlargest(remaining, scored, key=lambda item: (item[0], -len(lowered[item[1]]))):
+                    results.append({"name": names[i], "match": "fuzzy"})
+            return results[:limit], len(results) > limit
+
+# 获取变更日志数据库连接
+def get_file_index_db():
+    return connect_sqlite(current_app.config['FILE_INDEX_DB'], init_file_index_db)
+
+# 初始化文件名变更日志
+def init_file_index_db(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS file_index_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+# 记录文件新增或删除，其他进程搜索前据此同步索引
+def record_file_index_change(op, filename):
+    try:
+        conn = get_file_index_db()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO file_index_changes (op, filename, created_at) VALUES (?, ?, ?)",
+                (op, filename, time.time())
+            )
+            conn.execute("DELETE FROM file_index_changes WHERE id <= ?", (cursor.lastrowid - FILE_INDEX_CHANGE_LOG_SIZE,))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        # 记录失败时，索引会在下一次全量扫描时更新
+        logger.exception("Failed to record file index change for %s", filename)
+
+# 扫描热存储和次级存储中的所有文件名
+def scan_file_names():
+    names = []
+    with os.scandir(current_app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            if not entry.name.startswith('.') and entry.is_file():
+                names.append(entry.name)
+    names.extend(cold['filename'] for cold in list_cold_files())
+    return names
+
+# 全量扫描并重建索引；先记下日志位置，扫描期间的变更会在下次同步时重放
+def rebuild_filename_index(index):
+    conn = get_file_index_db()
+    try:
+        last_change_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM file_index_changes").fetchone()[0]
+    finally:
+        conn.close()
+    index.reset(scan_file_names())
+    index.last_change_id = last_change_id
+    index.scanned_at = time.monotonic()
+    logger.debug("Filename index rebuilt with %d files", len(index))
+
+# 按变更日志同步索引，返回是否需要全量重建（超过扫描间隔、日志已被清理或删除的条目过多）
+def sync_filename_index(index):
+    conn = get_file_index_db()
+    try:
+        oldest = conn.execute("SELECT MIN(id) FROM file_index_changes").fetchone()[0]
+        rows = conn.execute(
+            "SELECT id, op, filename FROM file_index_changes WHERE id > ? ORDER BY id", (index.last_change_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    # 日志已被清理时仍先应用可用的部分，完整结果等待重建
+    missed_changes = oldest is not None and oldest > index.last_change_id + 1 and index.last_change_id > 0
+    for row in rows:
+        if row["op"] == 'add':
+            index.add(row["filename"])
+        else:
+            index.remove(row["filename"])
+        index.last_change_id = row["id"]
+    return missed_changes or index.needs_compaction() or \
+        time.monotonic() - index.scanned_at >= current_app.config['FILE_INDEX_RESCAN_INTERVAL']
+
+# 在后台线程中全量扫描建立新索引，完成后重放扫描期间的变更并替换当前索引；
+# 重建期间搜索继续使用旧索引（调用方需持有filename_index_lock）
+def start_filename_index_rebuild(app):
+    if app.extensions.get('filename_index_rebuilding'):
+        return
+    app.extensions['filename_index_rebuilding'] = True
+    
+    def rebuild():
+        with app.app_context():
+            try:
+                index = FilenameIndex()
+                rebuild_filename_index(index)
+                with filename_index_lock:
+                    sync_filename_index(index)
+                    app.extensions['filename_index'] = index
+            except Exception:
+                logger.exception("Failed to rebuild filename index")
+                # 下一个扫描周期再重试，避免每次搜索都启动重建
+                with filename_index_lock:
+                    app.extensions['filename_index'].scanned_at = time.monotonic()
+            finally:
+                app.extensions['filename_index_rebuilding'] = False
+    
+    threading.Thread(target=rebuild, name="filename-index-rebuild", daemon=True).start()
+
+# 获取一组文件的列表项（索引中已不存在的文件会被跳过）
+def describe_files(filenames):
+    upload_dir = current_app.config['UPLOAD_FOLDER']
+    meta = load_storage_meta()
+    entries = []
+    for filename in filenames:
+        try:
+            stat = os.stat(os.path.join(upload_dir, filename))
+        except FileNotFoundError:
+            cold = get_cold_file(filename)
+            if cold is not None:
+                entries.append(format_file_entry(filename, cold['logical_size'], cold['mtime']))
+            continue
+        entries.append(format_file_entry(filename, get_logical_file_size(filename, stat, meta), stat.st_mtime))
+    return entries
+
+# 每个进程启动后在后台建立文件名索引，避免第一次搜索时等待全量扫描
+def ensure_filename_index_warming():
+    app = current_app._get_current_object()
+    if app.extensions.get('filename_index_warming_pid') == os.getpid():
+        return
+    with filename_index_lock:
+        if app.extensions.get('filename_index_warming_pid') == os.getpid():
+            return
+        app.extensions['filename_index_warming_pid'] = os.getpid()
+    
+    def warm():
+        with app.app_context():
+            try:
+                get_filename_index()
+            except Exception:
+                logger.exception("Failed to build filename index")
+    
+    threading.Thread(target=warm, name="filename-index", daemon=True).start()
+
+# 获取当前进程的文件名索引，首次使用时扫描目录建立；之后只按变更日志增量同步，全量重建在后台进行
+def get_filename_index():
+    app = current_app._get_current_object()
+    with filename_index_lock:
+        index = app.extensions.get('filename_index')
+        if index is None:
+            index = FilenameIndex()
+            rebuild_filename_index(index)
+            app.extensions['filename_index'] = index
+        elif sync_filename_index(index):
+            start_filename_index_rebuild(app)
+    return index
+
+# 令牌桶：允许透支，透支部分按速率折算为需要等待的时间，多个线程按申请顺序排队
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # 申请amount个令牌，返回需要等待的秒数
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# 单个被限速的传输，记录已传输字节数和当前速率
+class ShapedTransfer:
+    def __init__(self, client, direction, path, total_bytes):
+        self.id = str(uuid.uuid4())
+        self.client = client
+        self.direction = direction
+        self.path = path
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.rate = None
+        self.started_at = time.time()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    # 记录已传输的字节数，按1秒窗口计算当前速率
+    def record(self, amount):
+        self.bytes += amount
+        self.window_bytes += amount
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            self.rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+    @property
+    def current_rate(self):
+        if self.rate is not None:
+            return self.rate
+        # 第一个窗口尚未结束时使用平均速率
+        elapsed = time.time() - self.started_at
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'client': self.client,
+            'direction': self.direction,
+            'path': self.path,
+            'bytes': self.bytes,
+            'total_bytes': self.total_bytes,
+            'rate_bps': round(self.current_rate),
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat()
+        }
+
+
+# 带宽整形：全局和每个客户端各有一个令牌桶，大文件传输按块申请令牌；
+# 有普通页面请求进行中时，大文件传输按更高的代价消耗全局令牌，为普通请求让出带宽。
+# 限速状态保存在进程内，多个gunicorn worker时各自独立计算。
+class BandwidthShaper:
+    CHUNK_SIZE = 64 * 1024
+    # 客户端令牌桶空闲多久后回收（秒）
+    CLIENT_IDLE_SECONDS = 300
+
+    def __init__(self, global_rate=0, client_rate=0, burst=256 * 1024, interactive_share=0.5):
+        self.enabled = global_rate > 0 or client_rate > 0
+        self.global_bucket = TokenBucket(global_rate, burst) if global_rate > 0 else None
+        self.client_rate = client_rate
+        self.burst = burst
+        self.interactive_share = min(max(interactive_share, 0.0), 0.9)
+        self.client_buckets = {}
+        self.transfers = {}
+        self.interactive_requests = 0
+        self.lock = threading.Lock()
+
+    def get_client_bucket(self, client):
+        if self.client_rate <= 0:
+            return None
+        with self.lock:
+            entry = self.client_buckets.get(client)
+            now = time.monotonic()
+            if entry is None:
+                entry = self.client_buckets[client] = [TokenBucket(self.client_rate, self.burst), now]
+            entry[1] = now
+            # 顺便回收长时间空闲的客户端
+            for key in [k for k, v in self.client_buckets.items() if now - v[1] > self.CLIENT_IDLE_SECONDS]:
+                del self.client_buckets[key]
+            return entry[0]
+
+    def interactive_started(self):
+        with self.lock:
+            self.interactive_requests += 1
+
+    def interactive_finished(self):
+        with self.lock:
+            self.interactive_requests -= 1
+
+    def start_transfer(self, client, direction, path, total_bytes):
+        transfer = ShapedTransfer(client, direction, path, total_bytes)
+        with self.lock:
+            self.transfers[transfer.id] = transfer
+        return transfer
+
+    def finish_transfer(self, transfer):
+        with self.lock:
+            self.transfers.pop(transfer.id, None)
+
+    # 传输amount字节前调用，必要时等待
+    def throttle(self, transfer, client_bucket, amount):
+        delay = 0.0
+        if self.global_bucket is not None:
+            cost = amount
+            if self.interactive_requests > 0:
+                cost = amount / (1 - self.interactive_share)
+            delay = self.global_bucket.reserve(cost)
+        if client_bucket is not None:
+            delay = max(delay, client_bucket.reserve(amount))
+        if delay > 0:
+            time.sleep(delay)
+        transfer.record(amount)
+
+    def snapshot(self):
+        with self.lock:
+            transfers = [transfer.to_dict() for transfer in self.transfers.values()]
+            interactive_requests = self.interactive_requests
+        return {
+            'enabled': self.enabled,
+            'global_bps': self.global_bucket.rate if self.global_bucket else 0,
+            'client_bps': self.client_rate,
+            'interactive_requests': interactive_requests,
+            'total_rate_bps': sum(t['rate_bps'] for t in transfers),
+            'transfers': transfers
+        }
+
+
+# 被限速的响应体，响应关闭时（包括客户端中途断开）结束传输记录
+class ShapedBody:
+    def __init__(self, body, shaper, transfer):
+        self.body = body
+        self.shaper = shaper
+        self.transfer = transfer
+
+    def __iter__(self):
+        client_bucket = self.shaper.get_client_bucket(self.transfer.client)
+        for chunk in self.body:
+            for offset in range(0, len(chunk), self.shaper.CHUNK_SIZE):
+                piece = chunk[offset:offset + self.shaper.CHUNK_SIZE]
+                self.shaper.throttle(self.transfer, client_bucket, len(piece))
+                yield piece
+
+    def close(self):
+        self.shaper.finish_transfer(self.transfer)
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+# 被限速的请求体输入流，替换wsgi.input后表单解析时按块读取并限速
+class ShapedInput:
+    def __init__(self, stream, shaper, transfer):
+        self.stream = stream
+        self.shaper = shaper
+        self.transfer = transfer
+        self.client_bucket = shaper.get_client_bucket(transfer.client)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.shaper.CHUNK_SIZE:
+            size = self.shaper.CHUNK_SIZE
+        data = self.stream.read(size)
+        if data:
+            self.shaper.throttle(self.transfer, self.client_bucket, len(data))
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.shaper.CHUNK_SIZE:
+            size = self.shaper.CHUNK_SIZE
+        data = self.stream.readline(size)
+        if data:
+            self.shaper.throttle(self.transfer, self.client_bucket, len(data))
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+# 获取当前进程的带宽整形器
+def get_bandwidth_shaper():
+    return current_app.extensions['bandwidth_shaper']
+
+# 当前请求的客户端标识：登录用户名，未登录时使用IP
+def get_client_key():
+    return session.get('username') or request.remote_addr or 'unknown'
+
+# 对大文件下载响应限速
+def shape_download(response):
+    shaper = get_bandwidth_shaper()
+    size = response.content_length
+    if not shaper.enabled or (size is not None and size < current_app.config['BANDWIDTH_BULK_THRESHOLD']):
+        return response
+    transfer = shaper.start_transfer(get_client_key(), 'download', request.path, size)
+    response.response = ShapedBody(response.response, shaper, transfer)
+    return response
+
+# 请求开始时区分大文件上传和普通请求：大文件上传的请求体被限速，普通请求计入优先级统计
+@bp.before_app_request
+def start_bandwidth_shaping():
+    shaper = get_bandwidth_shaper()
+    if not shaper.enabled:
+        return
+    size = request.content_length
+    if size and size >= current_app.config['BANDWIDTH_BULK_THRESHOLD']:
+        transfer = shaper.start_transfer(get_client_key(), 'upload', request.path, size)
+        request.environ['wsgi.input'] = ShapedInput(request.environ['wsgi.input'], shaper, transfer)
+        g.upload_transfer = transfer
+    elif request.endpoint != 'main.download_file':
+        shaper.interactive_started()
+        g.interactive_request = True
+
+@bp.teardown_app_request
+def finish_bandwidth_shaping(exc):
+    shaper = get_bandwidth_shaper()
+    if g.pop('interactive_request', False):
+        shaper.interactive_finished()
+    transfer = g.pop('upload_transfer', None)
+    if transfer is not None:
+        shaper.finish_transfer(transfer)
+
+# 慢请求分析中间件：记录每个请求的首字节时间和总耗时。按比例抽样的请求用cProfile完整分析；
+# 其余请求运行超过一定时间后由后台线程定期采集调用栈，首字节时间超过阈值时保存为折叠栈格式
+# （可直接用于flamegraph.pl或speedscope）。记录保存在磁盘上的环形缓冲区中。
+# 下载和导出等流式响应的发送时间取决于客户端网速，只计入总耗时，不作为慢请求的依据。
+class RequestProfiler:
+    INDEX_FILE = 'index.json'
+    # 调用栈采样间隔（秒）
+    STACK_INTERVAL = 0.01
+
+    def __init__(self, wsgi_app, profile_dir, slow_ms=1000, sample_rate=0.0, max_entries=50):
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.max_entries = max_entries
+        # 请求运行超过该时间（秒）后开始采集调用栈
+        self.stack_after = min(slow_ms, 100) / 1000
+        # 线程ID -> [开始时间, 折叠栈计数]
+        self.active = {}
+        self.lock = threading.Lock()
+        self.sampler_pid = None
+        self.sampler_event = threading.Event()
+
+    def __call__(self, environ, start_response):
+        self.ensure_sampler_started()
+        status_holder = {}
 
-# 验证验证码
-def validate_captcha(user_input, session_captcha):
-    """验证用户输入的验证码是否正确"""
-    if not session_captcha or not user_input:
-        return False
-    return user_input.upper() == session_captcha.upper()
+        def capture_start_response(status, headers, exc_info=None):
+            status_holder['status'] = status
+            return start_response(status, headers, exc_info)
 
-# 加载剪贴板数据
-def load_clipboard_data():
-    try:
-        with open(CLIPBOARD_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # 如果文件不存在或解析失败，初始化文件
-        init_clipboard_storage()
-        with open(CLIPBOARD_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        profiler = None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # 同一时间只能有一个cProfile分析器（Python 3.12+），跳过本次抽样
+                profiler = None
 
-# 保存剪贴板数据
-def save_clipboard_data(data):
-    with open(CLIPBOARD_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        ident = threading.get_ident()
+        start = time.perf_counter()
+        state = self.active[ident] = [start, {}]
+        self.sampler_event.set()
 
-# 加载个人剪贴板数据
-def load_personal_clipboard_data():
-    try:
-        with open(PERSONAL_CLIPBOARD_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # 如果文件不存在或解析失败，初始化文件
-        init_personal_clipboard_storage()
-        with open(PERSONAL_CLIPBOARD_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        # 生成第一块响应数据时记下首字节时间并停止采集调用栈
+        first_chunk_at = []
 
-# 保存个人剪贴板数据
-def save_personal_clipboard_data(data):
-    with open(PERSONAL_CLIPBOARD_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        def first_chunk():
+            first_chunk_at.append(time.perf_counter())
+            self.active.pop(ident, None)
 
-# 创建个人剪贴板
-def create_personal_clipboard(name, content, creator):
-    # 对于单用户场景，创建者就是所有者
-    data = load_personal_clipboard_data()
-    clipboard = {
-        "id": str(uuid.uuid4()),
-        "name": name,
-        "content": content,
-        "creator": creator,
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
-    }
-    data["personal_clipboards"].append(clipboard)
-    save_personal_clipboard_data(data)
-    return clipboard
+        # 总耗时在响应体发送完毕（服务器调用close）时结束
+        def finish():
+            end = time.perf_counter()
+            elapsed_ms = (end - start) * 1000
+            ttfb_ms = ((first_chunk_at[0] if first_chunk_at else end) - start) * 1000
+            if profiler is not None:
+                profiler.disable()
+            self.active.pop(ident, None)
+            if profiler is not None or ttfb_ms >= self.slow_ms:
+                try:
+                    self.save_entry(environ, status_holder.get('status', ''), elapsed_ms, ttfb_ms, profiler, state[1])
+                except OSError:
+                    logger.exception("Failed to save request profile")
 
-# 获取用户创建的个人剪贴板
-def get_user_personal_clipboards(username):
-    data = load_personal_clipboard_data()
-    return [clipboard for clipboard in data["personal_clipboards"] 
-            if clipboard["creator"] == username]
+        try:
+            body = self.wsgi_app(environ, capture_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ProfiledBody(body, first_chunk, finish)
 
-# 获取特定个人剪贴板
-def get_personal_clipboard(clipboard_id, username):
-    data = load_personal_clipboard_data()
-    for clipboard in data["personal_clipboards"]:
-        if clipboard["id"] == clipboard_id and clipboard["creator"] == username:
-            return clipboard
-    return None
+    # 按需启动调用栈采样线程（每个进程一个）
+    def ensure_sampler_started(self):
+        if self.sampler_pid == os.getpid():
+            return
+        with self.lock:
+            if self.sampler_pid == os.getpid():
+                return
+            threading.Thread(target=self.sample_stacks, name='request-profiler', daemon=True).start()
+            self.sampler_pid = os.getpid()
 
-# 更新个人剪贴板内容
-def update_personal_clipboard(clipboard_id, content, username):
-    data = load_personal_clipboard_data()
-    for clipboard in data["personal_clipboards"]:
-        if clipboard["id"] == clipboard_id and clipboard["creator"] == username:
-            clipboard["content"] = content
-            clipboard["updated_at"] = datetime.now().isoformat()
-            save_personal_clipboard_data(data)
-            return clipboard
-    return None
+    # 定期采集运行时间较长的请求的调用栈，没有请求时休眠
+    def sample_stacks(self):
+        while True:
+            if not self.active:
+                self.sampler_event.wait()
+                self.sampler_event.clear()
+                continue
+            time.sleep(self.STACK_INTERVAL)
+            now = time.perf_counter()
+            frames = None
+            for ident, state in list(self.active.items()):
+                if now - state[0] < self.stack_after:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                state[1][key] = state[1].get(key, 0) + 1
+            frames = None
 
-# 删除个人剪贴板
-def delete_personal_clipboard(clipboard_id, username):
-    data = load_personal_clipboard_data()
-    # 用户可以删除自己创建的剪贴板
-    data["personal_clipboards"] = [
-        clipboard for clipboard in data["personal_clipboards"] 
-        if not (clipboard["id"] == clipboard_id and clipboard["creator"] == username)
-    ]
-    save_personal_clipboard_data(data)
+    # 加载分析记录索引
+    def load_index(self):
+        try:
+            with open(os.path.join(self.profile_dir, self.INDEX_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
 
-# 添加剪贴板项目
-def add_clipboard_item(content, owner, is_public=False):
-    # 限制剪贴板内容大小（最大1MB）
-    if len(content.encode('utf-8')) > 1024 * 1024:
-        raise ValueError("剪贴板内容不得超过1MB")
-    
-    # 过滤潜在的危险内容
-    # 移除可能的脚本标签（基础过滤）
-    filtered_content = re.sub(r'<script[^>]*>.*?</script>', '', content, flags=re.IGNORECASE | re.DOTALL)
-    
-    data = load_clipboard_data()
-    item = {
-        "id": str(uuid.uuid4()),
-        "content": filtered_content,
-        "owner": owner,
-        "created_at": datetime.now().isoformat(),
-        "is_public": is_public
-    }
-    data["clipboard_items"].append(item)
-    save_clipboard_data(data)
-    return item
+    # 保存一条分析记录，超出容量时删除最旧的记录及其文件
+    def save_entry(self, environ, status, elapsed_ms, ttfb_ms, profiler, stacks):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        entry_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profile_file = None
+        profile_kind = None
+        if profiler is not None:
+            profile_kind = 'cprofile'
+            profile_file = f"{entry_id}.prof"
+            profiler.dump_stats(os.path.join(self.profile_dir, profile_file))
+        elif stacks:
+            profile_kind = 'stacks'
+            profile_file = f"{entry_id}.folded.txt"
+            with open(os.path.join(self.profile_dir, profile_file), 'w', encoding='utf-8') as f:
+                for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
 
-# 获取用户的所有剪贴板项目
-def get_user_clipboard_items(username):
-    data = load_clipboard_data()
-    # 返回用户自己的项目和公开项目
-    return [item for item in data["clipboard_items"] 
-            if item["owner"] == username or item["is_public"]]
+        entry = {
+            'id': entry_id,
+            'created_at': datetime.now().isoformat(),
+            'method': environ.get('REQUEST_METHOD', ''),
+            'path': environ.get('PATH_INFO', ''),
+            'query': environ.get('QUERY_STRING', ''),
+            'status': status,
+            'duration_ms': round(elapsed_ms, 1),
+            'ttfb_ms': round(ttfb_ms, 1),
+            'slow': ttfb_ms >= self.slow_ms,
+            'kind': profile_kind,
+            'file': profile_file
+        }
+        with self.lock:
+            index = self.load_index()
+            index.append(entry)
+            expired, index = index[:-self.max_entries], index[-self.max_entries:]
+            tmp_path = os.path.join(self.profile_dir, self.INDEX_FILE + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(self.profile_dir, self.INDEX_FILE))
+        for old_entry in expired:
+            if old_entry.get('file'):
+                try:
+                    os.remove(os.path.join(self.profile_dir, old_entry['file']))
+                except FileNotFoundError:
+                    pass
 
-# 获取特定的剪贴板项目
-def get_clipboard_item(item_id, username):
-    data = load_clipboard_data()
-    for item in data["clipboard_items"]:
-        # 用户可以访问自己的项目或公开项目
-        if item["id"] == item_id and (item["owner"] == username or item["is_public"]):
-            return item
-    return None
+    # 获取最近的分析记录（最新的在前）
+    def recent_entries(self):
+        return list(reversed(self.load_index()))
 
-# 删除剪贴板项目
-def delete_clipboard_item(item_id, username):
-    data = load_clipboard_data()
-    # 用户只能删除自己的项目
-    data["clipboard_items"] = [item for item in data["clipboard_items"] 
-                              if not (item["id"] == item_id and item["owner"] == username)]
-    save_clipboard_data(data)
+    def get_entry(self, entry_id):
+        for entry in self.load_index():
+            if entry['id'] == entry_id:
+                return entry
+        return None
 
-# 登录页面模板
-# 允许的文件扩展名
-ALLOWED_EXTENSIONS = {
-    'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 
-    'ppt', 'pptx', 'zip', 'rar', '7z', 'tar', 'gz', 'mp3', 'mp4', 'avi', 'mov',
-    'mpg', 'mpeg', 'wmv', 'flv', 'webm', 'mkv', 'wav', 'ogg', 'ogv', 'm4a',
-    'py', 'js', 'java', 'c', 'cpp', 'html', 'css', 'php', 'go', 'rb', 'pl', 'sh', 'sql',
-    'md', 'yaml', 'yml', 'json', 'xml', 'conf', 'config', 'ini', 'cfg', 'env', 'env.example'
-}
 
-# 可预览的文本文件扩展名
-TEXT_PREVIEW_EXTENSIONS = {'txt', 'md', 'log', 'csv', 'json', 'xml', 'html', 'css', 'js', 'py', 'java', 'c', 'cpp', 'sql', 'yaml', 'yml', 'ini', 'cfg', 'conf', 'env', 'sh', 'pl', 'rb', 'go', 'php'}
+# 被分析请求的响应体：逐块转发，产生第一块数据时记录首字节时间，服务器关闭响应时结束计时
+class ProfiledBody:
+    def __init__(self, body, on_first_chunk, on_close):
+        self.body = body
+        self.on_first_chunk = on_first_chunk
+        self.on_close = on_close
 
-# 可预览的图片文件扩展名
-IMAGE_PREVIEW_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+    def __iter__(self):
+        for chunk in self.body:
+            on_first_chunk, self.on_first_chunk = self.on_first_chunk, None
+            if on_first_chunk is not None:
+                on_first_chunk()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close()
 
-# 压缩包文件扩展名
-ARCHIVE_EXTENSIONS = {'zip', 'rar', '7z', 'tar', 'gz'}
+
+# 检查当前用户是否为管理员
+def is_admin():
+    return session.get('username') == current_app.config['ADMIN_USERNAME']
 
 # 验证码生成路由
-@app.route('/captcha')
+@bp.route('/captcha')
 def captcha():
     """生成新的验证码"""
     captcha_text = generate_captcha_text()
@@ -304,7 +3288,7 @@ def captcha():
     return {'captcha_image': captcha_image}
 
 # 登录路由
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         # 检查表单字段是否存在
@@ -320,6 +3304,7 @@ def login():
         captcha = request.form['captcha']
 
         logger.debug("Login attempt - Username: %s", username)
+        users = get_users()
         logger.debug("Available users: %s", list(users.keys()))
         logger.debug("Session captcha: %s", session.get('captcha'))
         logger.debug("User input captcha: %s", captcha)
@@ -340,7 +3325,7 @@ def login():
             session['username'] = username
             # 登录成功后清除验证码
             session.pop('captcha', None)
-            return redirect(url_for('upload_file'))
+            return redirect(url_for('main.upload_file'))
         else:
             # 密码错误时，也生成新的验证码
             captcha_text = generate_captcha_text()
@@ -356,26 +3341,40 @@ def login():
     return render_template('login.html', captcha_image=captcha_image)
 
 # 登出路由
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.pop('username', None)
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
+
+# 文件列表中的一项
+def format_file_entry(filename, size, mtime):
+    return {
+        'name': filename,
+        'size': format_file_size(size),
+        'modified': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+    }
 
 # 获取文件列表
 def get_file_list():
     files = []
-    upload_dir = app.config['UPLOAD_FOLDER']
+    upload_dir = current_app.config['UPLOAD_FOLDER']
     
     if os.path.exists(upload_dir):
+        meta = load_storage_meta()
         for filename in os.listdir(upload_dir):
+            # 跳过内部使用的隐藏文件（如压缩存储元数据）
+            if filename.startswith('.'):
+                continue
             filepath = os.path.join(upload_dir, filename)
             if os.path.isfile(filepath):
                 stat = os.stat(filepath)
-                files.append({
-                    'name': filename,
-                    'size': format_file_size(stat.st_size),
-                    'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
-                })
+                files.append(format_file_entry(filename, get_logical_file_size(filename, stat, meta), stat.st_mtime))
+        
+        # 次级存储中的冷文件与本地文件一样列出
+        hot_names = {f['name'] for f in files}
+        for cold in list_cold_files():
+            if cold['filename'] not in hot_names:
+                files.append(format_file_entry(cold['filename'], cold['logical_size'], cold['mtime']))
     
     # 按修改时间排序，最新的在前
     files.sort(key=lambda x: x['modified'], reverse=True)
@@ -389,21 +3388,16 @@ def format_file_size(size):
         size /= 1024.0
     return f"{size:.1f} TB"
 
-# 获取目录总大小
-def get_directory_size(directory):
-    total_size = 0
-    if os.path.exists(directory):
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                if os.path.exists(filepath):
-                    total_size += os.path.getsize(filepath)
-    return total_size
-
-# 格式化存储信息
+# 格式化存储信息（容量限制按实际占用的物理字节计算）
 def format_storage_info():
-    used_bytes = get_directory_size(app.config['UPLOAD_FOLDER'])
-    max_bytes = MAX_STORAGE_BYTES
+    used_bytes = get_used_storage_bytes()
+    max_bytes = current_app.config['MAX_STORAGE_BYTES']
+    
+    # 逻辑大小 = 物理大小 + 压缩节省的字节数
+    logical_bytes = used_bytes
+    for info in load_storage_meta()["files"].values():
+        if info.get("encoding"):
+            logical_bytes += info["size"] - info["stored_size"]
     
     used_formatted = format_file_size(used_bytes)
     max_formatted = format_file_size(max_bytes)
@@ -412,8 +3406,10 @@ def format_storage_info():
     return {
         'used_storage': used_formatted,
         'max_storage': max_formatted,
+        'logical_storage': format_file_size(logical_bytes),
         'usage_percentage': usage_percentage,
         'used_bytes': used_bytes,
+        'logical_bytes': logical_bytes,
         'max_bytes': max_bytes
     }
 
@@ -465,19 +3461,20 @@ def get_file_type_description(filename):
     return '未知类型文件'
 
 # 文件管理页面（上传和文件列表）
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/upload', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/upload', methods=['GET', 'POST'])
 def upload_file():
     # 调试信息
     logger.debug("Session contents: %s", dict(session))
     # 检查用户是否已登录
     if 'username' not in session:
         logger.debug("User not in session, redirecting to login")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     logger.debug("User is logged in: %s", session['username'])
     
     # 获取存储信息
     storage_info = format_storage_info()
+    storage_info['user_quota_info'] = get_user_quota_info(session['username'])
     storage_full = storage_info['used_bytes'] >= storage_info['max_bytes']
     storage_warning = storage_info['usage_percentage'] >= 80
     
@@ -509,8 +3506,7 @@ def upload_file():
             )
 
         ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        current_usage = storage_info['used_bytes']
-        max_storage = storage_info['max_bytes']
+        username = session['username']
         successful_uploads = []
         errors = []
 
@@ -530,20 +3526,33 @@ def upload_file():
                 )
                 continue
 
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
 
             file.seek(0, os.SEEK_END)
             file_size = file.tell()
             file.seek(0)
 
-            if current_usage + file_size > max_storage:
-                errors.append(
-                    f'{filename}: 上传此文件将超出存储限制，请删除一些文件后再试。'
-                )
+            # 先原子地预留空间，写入成功后提交，失败则释放
+            try:
+                reservation_id = reserve_storage(username, filename, file_size)
+            except QuotaExceeded as e:
+                errors.append(f'{filename}: {e}')
                 continue
 
-            file.save(filepath)
-            current_usage += file_size
+            try:
+                stored_size = save_uploaded_file(file, filepath, file_size)
+            except Exception:
+                release_reservation(reservation_id)
+                raise
+            commit_reservation(reservation_id, username, filename, stored_size)
+            # 新上传的文件取代次级存储中的同名旧文件
+            forget_tiered_file(filename, keep_access_stats=True)
+            record_file_index_change('add', filename)
+            try:
+                enqueue_post_upload_jobs(filename)
+            except (sqlite3.Error, OSError):
+                # 后处理任务入队失败不影响上传结果
+                logger.exception("Failed to enqueue post-upload jobs for %s", filename)
             successful_uploads.append({
                 'name': filename,
                 'size': format_file_size(file_size)
@@ -558,17 +3567,18 @@ def upload_file():
                 'errors': errors,
                 'storage': {
                     'used_storage': updated_storage['used_storage'],
+                    'logical_storage': updated_storage['logical_storage'],
                     'usage_percentage': updated_storage['usage_percentage']
                 }
             }
-            return app.response_class(
+            return current_app.response_class(
                 response=json.dumps(response_data, ensure_ascii=False),
                 mimetype='application/json'
             )
 
         # 非 AJAX 请求：若有成功上传的文件则重定向，否则返回错误信息
         if successful_uploads:
-            return redirect(url_for('upload_file'))
+            return redirect(url_for('main.upload_file'))
 
         files = get_file_list()
         return render_template(
@@ -590,19 +3600,65 @@ def upload_file():
                                 storage_full=storage_full,
                                 storage_warning=storage_warning)
 
+# 设置下载文件名，非ASCII文件名按RFC 5987编码（与send_file的处理一致）
+def set_attachment_filename(response, filename):
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': "UTF-8''" + quote(filename, safe="!#$&+^`|~")}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+
+# 发送已打开的文件，与send_file按路径发送时一样支持条件请求和断点续传
+def send_opened_file(fileobj, stat, mimetype, filename):
+    response = send_file(fileobj, mimetype=mimetype, as_attachment=True, download_name=filename,
+                         conditional=False, etag=False, last_modified=stat.st_mtime)
+    response.content_length = stat.st_size
+    response.set_etag(format_file_version(stat))
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable:
+        fileobj.close()
+        raise
+
 # 下载文件的路由（无需登录即可下载）
-@app.route('/download/<filename>')
+@bp.route('/download/<filename>')
 def download_file(filename):
     # 检查文件名是否安全
     if not is_safe_filename(filename):
         abort(404)
     
-    # 检查文件是否存在
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(filepath):
+    # 检查文件是否存在（冷文件会先从次级存储取回）
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    if not ensure_hot_file(filename):
         abort(404)
-        
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+    record_file_access(filename)
+    
+    # 先打开文件再确定编码，之后文件被替换也只会发送已打开的版本
+    try:
+        stored_file, stat, info = open_stored_file_raw(filepath)
+    except FileNotFoundError:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if not info:
+        return shape_download(send_opened_file(stored_file, stat, mimetype, filename))
+    
+    # 压缩存储的文件：客户端支持该编码时直接发送，否则流式解压
+    if request.accept_encodings[info["encoding"]] > 0:
+        response = send_opened_file(stored_file, stat, mimetype, filename)
+        response.headers['Content-Encoding'] = info["encoding"]
+    else:
+        if info["encoding"] == 'zstd' and zstandard is None:
+            stored_file.close()
+            raise RuntimeError("文件以zstd压缩存储，但服务器未安装zstandard")
+        stored_file = open_decoded_stream(stored_file, info["encoding"])
+        response = current_app.response_class(iter_file_chunks(stored_file), mimetype=mimetype, direct_passthrough=True)
+        response.call_on_close(stored_file.close)
+        response.headers['Content-Length'] = str(info["size"])
+        set_attachment_filename(response, filename)
+    response.vary.add('Accept-Encoding')
+    return shape_download(response)
 
 # 获取文件预览类型
 def get_preview_type(filename):
@@ -621,20 +3677,25 @@ def get_preview_type(filename):
 # 读取文本文件内容（带大小限制）
 def read_text_file(filepath, max_size=1024*1024):  # 限制1MB
     try:
-        file_size = os.path.getsize(filepath)
+        file_size = get_logical_file_size(os.path.basename(filepath), os.stat(filepath))
         if file_size > max_size:
             return None, f"文件太大，无法预览（文件大小：{format_file_size(file_size)}，最大支持：{format_file_size(max_size)}）"
         
+        # 压缩存储的文件会被透明解压
+        with open_stored_file(filepath) as f:
+            raw = f.read()
+        
         # 尝试不同的编码方式读取文件
         encodings = ['utf-8', 'gbk', 'gb2312', 'latin-1']
         for encoding in encodings:
             try:
-                with open(filepath, 'r', encoding=encoding) as f:
-                    content = f.read()
-                    # 如果文件内容过大，截取前部分
-                    if len(content) > 10000:  # 限制显示字符数
-                        content = content[:10000] + '\n\n... (内容已截取，仅显示前10000个字符)'
-                    return content, None
+                content = raw.decode(encoding)
+                # 统一换行符，与文本模式读取保持一致
+                content = content.replace('\r\n', '\n').replace('\r', '\n')
+                # 如果文件内容过大，截取前部分
+                if len(content) > 10000:  # 限制显示字符数
+                    content = content[:10000] + '\n\n... (内容已截取，仅显示前10000个字符)'
+                return content, None
             except UnicodeDecodeError:
                 continue
         
@@ -643,11 +3704,11 @@ def read_text_file(filepath, max_size=1024*1024):  # 限制1MB
         return None, f"读取文件时发生错误：{str(e)}"
 
 # 预览文件的路由
-@app.route('/preview/<filename>')
+@bp.route('/preview/<filename>')
 def preview_file(filename):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # 检查文件名是否安全
     if not is_safe_filename(filename):
@@ -655,17 +3716,18 @@ def preview_file(filename):
                                     filename=filename,
                                     error="文件名不安全，无法预览")
     
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
     
-    # 检查文件是否存在
-    if not os.path.exists(filepath) or not os.path.isfile(filepath):
+    # 检查文件是否存在（冷文件会先从次级存储取回）
+    if not ensure_hot_file(filename) or not os.path.isfile(filepath):
         return render_template('preview.html', 
                                     filename=filename,
                                     error="文件不存在，无法预览")
+    record_file_access(filename)
     
     # 获取文件信息
     stat = os.stat(filepath)
-    file_size = format_file_size(stat.st_size)
+    file_size = format_file_size(get_logical_file_size(filename, stat))
     modified_time = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
     
     # 获取预览类型
@@ -712,29 +3774,194 @@ def preview_file(filename):
                                     modified_time=modified_time,
                                     preview_type='unknown')
 
+# 文件后处理状态接口
+@bp.route('/files/<filename>/status')
+def file_status(filename):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    if not is_safe_filename(filename):
+        abort(404)
+    
+    return get_file_job_status(filename)
+
+# 文件名搜索接口：q为关键字，支持 ext:pdf / *.pdf 按扩展名过滤，fuzzy=0关闭模糊匹配
+@bp.route('/search')
+def search_files():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_MAX_LIMIT))
+    fuzzy = request.args.get('fuzzy', '1') != '0'
+    index = get_filename_index()
+    started = time.perf_counter()
+    matches, truncated = index.search(query, limit, fuzzy)
+    took_ms = (time.perf_counter() - started) * 1000
+    
+    kinds = {match['name']: match['match'] for match in matches}
+    results = describe_files([match['name'] for match in matches])
+    for entry in results:
+        entry['match'] = kinds[entry['name']]
+    return {
+        'success': True,
+        'query': query,
+        'results': results,
+        'truncated': truncated,
+        'total_files': len(index),
+        'took_ms': round(took_ms, 2)
+    }
+
+# 已有文件的分块签名，供客户端计算增量
+@bp.route('/files/<filename>/signature')
+def file_signature(filename):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    if not is_safe_filename(filename) or not ensure_hot_file(filename):
+        return {'success': False, 'error': '文件不存在'}, 404
+    return {'success': True, **compute_file_signature(filename)}
+
+# 增量上传：表单字段delta为JSON（filename、base_version、block_size、size、ops），
+# 文件字段literal为所有data操作的字面数据按顺序拼接
+@bp.route('/upload/delta', methods=['POST'])
+def delta_upload():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    try:
+        delta = json.loads(request.form.get('delta', ''))
+    except ValueError:
+        delta = None
+    if not isinstance(delta, dict):
+        return {'success': False, 'error': '请求缺少增量描述'}, 400
+    
+    filename = delta.get('filename')
+    if not isinstance(filename, str) or not is_safe_filename(filename) or not allowed_file(filename):
+        return {'success': False, 'error': '文件名不合法'}, 400
+    base_version = delta.get('base_version')
+    block_size = delta.get('block_size')
+    size = delta.get('size')
+    if not isinstance(base_version, str) or not isinstance(block_size, int) or not isinstance(size, int) \
+            or not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE or size < 0:
+        return {'success': False, 'error': '增量描述缺少base_version、block_size或size'}, 400
+    
+    literal = request.files.get('literal')
+    try:
+        stats = apply_delta_upload(filename, session['username'], base_version, block_size,
+                                   delta.get('ops'), size, literal.stream if literal else io.BytesIO())
+    except FileNotFoundError:
+        return {'success': False, 'error': '文件不存在'}, 404
+    except DeltaConflict as e:
+        return {'success': False, 'error': str(e)}, 409
+    except DeltaError as e:
+        return {'success': False, 'error': str(e)}, 400
+    except QuotaExceeded as e:
+        return {'success': False, 'error': str(e)}, 413
+    
+    updated_storage = format_storage_info()
+    return {
+        'success': True,
+        'uploaded': [{'name': filename, 'size': format_file_size(size)}],
+        'delta': stats,
+        'storage': {
+            'used_storage': updated_storage['used_storage'],
+            'logical_storage': updated_storage['logical_storage'],
+            'usage_percentage': updated_storage['usage_percentage']
+        }
+    }
+
+# 当前进程中正在进行的限速传输及其速率
+@bp.route('/transfers')
+def transfers():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    return get_bandwidth_shaper().snapshot()
+
+# 慢请求列表（仅管理员）
+@bp.route('/admin/profiles')
+def admin_profiles():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    if not is_admin():
+        abort(403)
+    
+    profiler = current_app.extensions.get('request_profiler')
+    return render_template('profiles.html',
+                                username=session['username'],
+                                enabled=profiler is not None,
+                                slow_ms=current_app.config['PROFILER_SLOW_MS'],
+                                sample_rate=current_app.config['PROFILER_SAMPLE_RATE'],
+                                entries=profiler.recent_entries() if profiler else [])
+
+# 下载慢请求的分析文件（仅管理员）
+@bp.route('/admin/profiles/<entry_id>')
+def download_profile(entry_id):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    if not is_admin():
+        abort(403)
+    
+    profiler = current_app.extensions.get('request_profiler')
+    entry = profiler.get_entry(entry_id) if profiler else None
+    if not entry or not entry.get('file'):
+        abort(404)
+    return send_from_directory(profiler.profile_dir, entry['file'], as_attachment=True)
+
+# 分层存储的占用情况和取回耗时（仅管理员）
+@bp.route('/admin/tiering')
+def admin_tiering():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    if not is_admin():
+        abort(403)
+    
+    return get_tiering_report()
+
+# 立即执行一次分层整理（仅管理员）
+@bp.route('/admin/tiering/sweep', methods=['POST'])
+def admin_tiering_sweep():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    if not is_admin():
+        abort(403)
+    if not current_app.config['TIERING_ENABLED']:
+        return {'success': False, 'error': '分层存储未启用'}, 400
+    
+    enqueue_job('tier_sweep', f"tier_sweep:manual:{uuid.uuid4().hex}")
+    return {'success': True}
+
 # 删除文件的路由
-@app.route('/delete/<filename>')
+@bp.route('/delete/<filename>')
 def delete_file(filename):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # 检查文件名是否安全
     if not is_safe_filename(filename):
-        return redirect(url_for('upload_file'))
+        return redirect(url_for('main.upload_file'))
     
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(filepath) and os.path.isfile(filepath):
-        os.remove(filepath)
+    delete_stored_file(filename)
     
-    return redirect(url_for('upload_file'))
+    return redirect(url_for('main.upload_file'))
 
 # 批量删除文件的路由
-@app.route('/delete_selected', methods=['POST'])
+@bp.route('/delete_selected', methods=['POST'])
 def delete_selected_files():
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # 获取要删除的文件名列表
     data = request.get_json()
@@ -744,20 +3971,17 @@ def delete_selected_files():
     deleted_count = 0
     for filename in filenames:
         # 检查文件名是否安全
-        if is_safe_filename(filename):
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.exists(filepath) and os.path.isfile(filepath):
-                os.remove(filepath)
-                deleted_count += 1
+        if is_safe_filename(filename) and delete_stored_file(filename):
+            deleted_count += 1
     
     return {'success': True, 'deleted_count': deleted_count}
 
 # 剪贴板页面路由
-@app.route('/clipboard', methods=['GET', 'POST'])
+@bp.route('/clipboard', methods=['GET', 'POST'])
 def clipboard():
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     error_message = None
@@ -785,23 +4009,23 @@ def clipboard():
                                 error=error_message)
 
 # 删除剪贴板项目的路由
-@app.route('/clipboard/delete/<item_id>')
+@bp.route('/clipboard/delete/<item_id>')
 def delete_clipboard_item_route(item_id):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     delete_clipboard_item(item_id, username)
     
-    return redirect(url_for('clipboard'))
+    return redirect(url_for('main.clipboard'))
 
 # 获取剪贴板内容的API路由（需要认证）
-@app.route('/clipboard/get/<item_id>')
+@bp.route('/clipboard/get/<item_id>')
 def get_clipboard_item_route(item_id):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     item = get_clipboard_item(item_id, username)
@@ -812,7 +4036,7 @@ def get_clipboard_item_route(item_id):
         return "剪贴板项目未找到或无权访问", 404
 
 # 获取公开剪贴板内容的路由（无需认证）
-@app.route('/clipboard/public/<item_id>')
+@bp.route('/clipboard/public/<item_id>')
 def get_public_clipboard_item_route(item_id):
     data = load_clipboard_data()
     for item in data["clipboard_items"]:
@@ -822,11 +4046,11 @@ def get_public_clipboard_item_route(item_id):
     return "公开剪贴板项目未找到", 404
 
 # 个人剪贴板列表页面
-@app.route('/personal_clipboard', methods=['GET', 'POST'])
+@bp.route('/personal_clipboard', methods=['GET', 'POST'])
 def personal_clipboard():
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     error_message = None
@@ -851,11 +4075,11 @@ def personal_clipboard():
                                 error=error_message)
 
 # 个人剪贴板详情页面
-@app.route('/personal_clipboard/<clipboard_id>', methods=['GET', 'POST'])
+@bp.route('/personal_clipboard/<clipboard_id>', methods=['GET', 'POST'])
 def personal_clipboard_detail(clipboard_id):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     error_message = None
@@ -868,33 +4092,223 @@ def personal_clipboard_detail(clipboard_id):
     if request.method == 'POST':
         # 处理保存内容
         content = request.form.get('content', '')
+        base_version = request.form.get('base_version', type=int)
         try:
-            update_personal_clipboard(clipboard_id, content, username)
+            update_personal_clipboard(clipboard_id, content, username, base_version)
             # 更新成功后重新获取剪贴板内容
             clipboard = get_personal_clipboard(clipboard_id, username)
+        except PersonalClipboardConflict as e:
+            error_message = str(e)
+            clipboard = e.clipboard
         except Exception as e:
             error_message = str(e)
     
+    page = max(1, request.args.get('page', 1, type=int))
+    versions, version_count = get_personal_clipboard_versions(clipboard_id, username, page)
+    page_count = max(1, -(-version_count // PERSONAL_CLIPBOARD_VERSIONS_PAGE_SIZE))
     return render_template('personal_clipboard_detail.html', 
                                 username=username, 
                                 clipboard=clipboard,
+                                versions=versions or [],
+                                version_count=version_count,
+                                page=page,
+                                page_count=page_count,
                                 error=error_message)
 
+# 个人剪贴板增量更新接口（乐观并发控制）
+@bp.route('/personal_clipboard/<clipboard_id>/patch', methods=['POST'])
+def patch_personal_clipboard_route(clipboard_id):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    username = session['username']
+    payload = request.get_json(silent=True) or {}
+    base_version = payload.get('base_version')
+    ops = payload.get('ops')
+    if not isinstance(base_version, int) or isinstance(base_version, bool) or ops is None:
+        return {'success': False, 'error': '请求缺少base_version或ops'}, 400
+    
+    try:
+        clipboard = patch_personal_clipboard(clipboard_id, base_version, ops, username)
+    except PersonalClipboardConflict as e:
+        # 返回当前版本，客户端据此重新计算增量
+        return {
+            'success': False,
+            'error': str(e),
+            'version': e.clipboard.get('version', 1),
+            'content': e.clipboard['content']
+        }, 409
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+    
+    if not clipboard:
+        return {'success': False, 'error': '个人剪贴板未找到或无权访问'}, 404
+    return {
+        'success': True,
+        'version': clipboard.get('version', 1),
+        'updated_at': clipboard['updated_at']
+    }
+
+# 个人剪贴板历史版本列表
+@bp.route('/personal_clipboard/<clipboard_id>/history')
+def personal_clipboard_history_route(clipboard_id):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    page = max(1, request.args.get('page', 1, type=int))
+    versions, version_count = get_personal_clipboard_versions(clipboard_id, session['username'], page)
+    if versions is None:
+        return {'success': False, 'error': '个人剪贴板未找到或无权访问'}, 404
+    return {
+        'success': True,
+        'versions': versions,
+        'total': version_count,
+        'page': page,
+        'page_size': PERSONAL_CLIPBOARD_VERSIONS_PAGE_SIZE
+    }
+
+# 获取个人剪贴板指定历史版本的内容
+@bp.route('/personal_clipboard/<clipboard_id>/versions/<int:version>')
+def personal_clipboard_version_route(clipboard_id, version):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    content = get_personal_clipboard_version(clipboard_id, version, session['username'])
+    if content is None:
+        return "历史版本未找到或无权访问", 404
+    return current_app.response_class(response=content, mimetype='text/plain')
+
+# 恢复个人剪贴板的历史版本
+@bp.route('/personal_clipboard/<clipboard_id>/restore/<int:version>', methods=['POST'])
+def restore_personal_clipboard_route(clipboard_id, version):
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    if restore_personal_clipboard_version(clipboard_id, version, session['username']) is None:
+        return "历史版本未找到或无权访问", 404
+    return redirect(url_for('main.personal_clipboard_detail', clipboard_id=clipboard_id))
+
 # 删除个人剪贴板的路由
-@app.route('/personal_clipboard/delete/<clipboard_id>')
+@bp.route('/personal_clipboard/delete/<clipboard_id>')
 def delete_personal_clipboard_route(clipboard_id):
     # 检查用户是否已登录
     if 'username' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     username = session['username']
     delete_personal_clipboard(clipboard_id, username)
     
-    return redirect(url_for('personal_clipboard'))
+    return redirect(url_for('main.personal_clipboard'))
+
+# 批量添加/删除剪贴板项目接口：{"add": [{"content": ..., "is_public": ...}], "delete": [id, ...]}
+@bp.route('/api/clipboard/bulk', methods=['POST'])
+def bulk_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return {'success': False, 'error': '请求体必须是JSON对象'}, 400
+    adds = payload.get('add') or []
+    delete_ids = payload.get('delete') or []
+    if not isinstance(adds, list) or not isinstance(delete_ids, list):
+        return {'success': False, 'error': 'add和delete必须是数组'}, 400
+    
+    result = bulk_update_clipboard_items(adds, delete_ids, session['username'])
+    return {'success': not result['errors'], **result}
+
+# 以NDJSON格式导出当前用户的剪贴板项目
+@bp.route('/api/clipboard/export')
+def export_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    username = session['username']
+    init_clipboard_storage()
+    items = (item for item in iter_json_array_items(current_app.config['CLIPBOARD_FILE'], 'clipboard_items')
+             if item["owner"] == username)
+    return ndjson_response(items, 'clipboard.ndjson')
+
+# 从NDJSON导入剪贴板项目，逐条返回结果，最后一行为汇总
+@bp.route('/api/clipboard/import', methods=['POST'])
+def import_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    username = session['username']
+    records = import_ndjson_records(
+        request.stream,
+        lambda record: clipboard_item_from_record(record, username),
+        commit_imported_clipboard_items
+    )
+    return ndjson_response(records)
+
+# 批量添加/删除个人剪贴板接口：{"add": [{"name": ..., "content": ...}], "delete": [id, ...]}
+@bp.route('/api/personal_clipboard/bulk', methods=['POST'])
+def bulk_personal_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return {'success': False, 'error': '请求体必须是JSON对象'}, 400
+    adds = payload.get('add') or []
+    delete_ids = payload.get('delete') or []
+    if not isinstance(adds, list) or not isinstance(delete_ids, list):
+        return {'success': False, 'error': 'add和delete必须是数组'}, 400
+    
+    result = bulk_update_personal_clipboards(adds, delete_ids, session['username'])
+    return {'success': not result['errors'], **result}
+
+# 以NDJSON格式导出当前用户的个人剪贴板
+@bp.route('/api/personal_clipboard/export')
+def export_personal_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    username = session['username']
+    init_personal_clipboard_storage()
+    clipboards = (clipboard for clipboard in iter_json_array_items(
+                      current_app.config['PERSONAL_CLIPBOARD_FILE'], 'personal_clipboards')
+                  if clipboard["creator"] == username)
+    return ndjson_response(clipboards, 'personal_clipboard.ndjson')
+
+# 从NDJSON导入个人剪贴板，逐条返回结果，最后一行为汇总
+@bp.route('/api/personal_clipboard/import', methods=['POST'])
+def import_personal_clipboard_route():
+    # 检查用户是否已登录
+    if 'username' not in session:
+        return redirect(url_for('main.login'))
+    
+    username = session['username']
+    records = import_ndjson_records(
+        request.stream,
+        lambda record: prepare_personal_clipboard(record.get("name"), record.get("content", ""), username),
+        commit_imported_personal_clipboards
+    )
+    return ndjson_response(records)
+
+# 处理请求前确保后台任务线程已启动（包括继续处理重启前遗留的任务），按周期安排分层整理，并在后台建立文件名索引；
+# 同时完成个人剪贴板换行符的一次性迁移，并按周期核对存储占用账本
+@bp.before_app_request
+def start_job_workers():
+    migrate_personal_clipboard_newlines()
+    ensure_job_workers_started()
+    maybe_schedule_storage_reconcile()
+    maybe_schedule_tier_sweep()
+    ensure_filename_index_warming()
 
-# 应用启动时初始化剪贴板存储
-init_clipboard_storage()
-init_personal_clipboard_storage()
+# 默认应用实例（gunicorn app:app），也可以使用 app:create_app() 自行创建
+app = create_app()
 
 if __name__ == '__main__':
     # 获取环境变量设置，如果没有设置则默认为False
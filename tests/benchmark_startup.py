@@ -0,0 +1,88 @@
+"""启动耗时基准：测量从导入应用到返回第一个响应的时间，以及单个worker进程的内存占用。
+
+每轮在全新的Python子进程中执行，模拟gunicorn回收worker后重新加载应用的开销。
+
+用法:
+    python tests/benchmark_startup.py [--runs 5] [--path /login]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# 子进程中执行的测量代码
+CHILD_CODE = r'''
+import json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as app_module
+imported = time.perf_counter()
+client = app_module.app.test_client()
+response = client.get(sys.argv[2])
+responded = time.perf_counter()
+
+def read_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节，Linux返回KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+print(json.dumps({
+    'status': response.status_code,
+    'import_ms': (imported - start) * 1000,
+    'first_response_ms': (responded - start) * 1000,
+    'rss_kb': read_rss_kb(),
+    'pil_loaded': 'PIL' in sys.modules,
+}))
+'''
+
+
+def run_once(path, upload_folder):
+    env = dict(os.environ)
+    env.setdefault('UPLOAD_FOLDER', upload_folder)
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD_CODE, SRC_DIR, path],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(values):
+    return {
+        'min': round(min(values), 1),
+        'median': round(statistics.median(values), 1),
+        'max': round(max(values), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量应用启动到首个响应的耗时和内存占用')
+    parser.add_argument('--runs', type=int, default=5, help='测量轮数')
+    parser.add_argument('--path', default='/login', help='第一个请求的路径')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as upload_folder:
+        results = [run_once(args.path, upload_folder) for _ in range(args.runs)]
+
+    print(f"路径: {args.path}  轮数: {args.runs}  状态码: {sorted({r['status'] for r in results})}")
+    print(f"导入耗时 (ms):     {summarize([r['import_ms'] for r in results])}")
+    print(f"首个响应耗时 (ms): {summarize([r['first_response_ms'] for r in results])}")
+    print(f"进程RSS (KB):      {summarize([r['rss_kb'] for r in results])}")
+    print(f"首个响应后已加载Pillow: {any(r['pil_loaded'] for r in results)}")
+
+
+if __name__ == '__main__':
+    main()
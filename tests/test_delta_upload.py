@@ -0,0 +1,277 @@
+"""增量上传测试：校验增量操作、按增量重建文件，以及版本冲突和大小不一致时的处理。
+
+重建结果必须与新文件逐字节一致，包括大小不是分块整数倍的基础文件和压缩存储的基础文件。
+
+用法:
+    python -m pytest tests/test_delta_upload.py
+"""
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+# 导入时会创建默认应用，避免在项目目录下创建uploads
+os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp())
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app as app_module  # noqa: E402
+
+BLOCK_SIZE = app_module.DELTA_MIN_BLOCK_SIZE
+
+
+def make_text(start, count):
+    return ''.join(f'line {i:05d} of the delta upload test file\n' for i in range(start, start + count)).encode()
+
+
+# 按客户端的方式生成增量：能匹配到已有块的位置复制，其余作为字面数据。
+# 不完整的最后一块只在紧接着上一块之后匹配（与upload.html中的computeDelta一致）
+def build_delta(base, new, block_size=BLOCK_SIZE):
+    block_count = (len(base) + block_size - 1) // block_size
+    partial = base[(block_count - 1) * block_size:] if len(base) % block_size else None
+    blocks = {}
+    for index in range(block_count - (1 if partial else 0)):
+        blocks.setdefault(base[index * block_size:(index + 1) * block_size], index)
+    ops, literal = [], bytearray()
+    pending = bytearray()
+
+    def flush_pending():
+        if pending:
+            ops.append(['data', len(pending)])
+            literal.extend(pending)
+            pending.clear()
+
+    pos = 0
+    next_block = 0
+    while pos < len(new):
+        if partial and next_block == block_count - 1 and new[pos:pos + len(partial)] == partial:
+            index, window = next_block, partial
+        else:
+            window = new[pos:pos + block_size]
+            index = blocks.get(window) if len(window) == block_size else None
+        if index is None:
+            pending.append(new[pos])
+            pos += 1
+            continue
+        flush_pending()
+        if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == index:
+            ops[-1][2] += 1
+        else:
+            ops.append(['copy', index, 1])
+        next_block = index + 1
+        pos += len(window)
+    flush_pending()
+    return ops, bytes(literal)
+
+
+@pytest.fixture(params=['off', 'gzip'])
+def app(request, tmp_path):
+    flask_app = app_module.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'STORAGE_COMPRESSION': request.param,
+        'STORAGE_COMPRESSION_MIN_BYTES': 1024,
+        'JOB_WORKERS': 0,
+        'TESTING': True,
+    })
+    with flask_app.app_context():
+        yield flask_app
+
+
+# 按压缩策略保存基础文件，返回文件版本
+def store_base(app, filename, data):
+    upload_dir = app.config['UPLOAD_FOLDER']
+    tmp_path = os.path.join(upload_dir, '.base.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    filepath = os.path.join(upload_dir, filename)
+    app_module.store_reconstructed_file(tmp_path, filepath, len(data))
+    return app_module.get_file_version(filepath)
+
+
+def read_logical(app, filename):
+    with app_module.open_stored_file(os.path.join(app.config['UPLOAD_FOLDER'], filename)) as f:
+        return f.read()
+
+
+def reconstruct(app, filename, new, base):
+    ops, literal = build_delta(base, new)
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], '.result.tmp')
+    copied, append_only = app_module.reconstruct_from_delta(filename, BLOCK_SIZE, ops, io.BytesIO(literal), tmp_path)
+    with open(tmp_path, 'rb') as f:
+        return f.read(), copied, append_only
+
+
+class TestValidateDeltaOps:
+    def test_counts_literal_bytes(self):
+        assert app_module.validate_delta_ops([['copy', 0, 2], ['data', 10], ['data', 5]], 3) == (15, False)
+
+    @pytest.mark.parametrize('ops', [
+        'copy',
+        [['copy', 0]],
+        [['copy', 0, 1, 2]],
+        [['data']],
+        [['move', 0, 1]],
+        [[]],
+        [['copy', -1, 1]],
+        [['data', True]],
+        [['data', 1.5]],
+    ])
+    def test_rejects_malformed_ops(self, ops):
+        with pytest.raises(app_module.DeltaError):
+            app_module.validate_delta_ops(ops, 4)
+
+    def test_rejects_blocks_beyond_base(self):
+        app_module.validate_delta_ops([['copy', 2, 2]], 4)
+        with pytest.raises(app_module.DeltaError):
+            app_module.validate_delta_ops([['copy', 3, 2]], 4)
+
+    @pytest.mark.parametrize('ops, expected', [
+        ([['copy', 0, 4]], True),
+        ([['copy', 0, 4], ['data', 7]], True),
+        ([['copy', 0, 3], ['data', 7]], False),
+        ([['copy', 0, 2], ['copy', 2, 2]], False),
+        ([['data', 7], ['copy', 0, 4]], False),
+        ([['copy', 0, 4], ['data', 7], ['data', 1]], False),
+    ])
+    def test_detects_append_only(self, ops, expected):
+        assert app_module.validate_delta_ops(ops, 4)[1] is expected
+
+    def test_empty_base_is_never_append_only(self):
+        assert app_module.validate_delta_ops([['data', 5]], 0) == (5, False)
+
+
+class TestReconstructFromDelta:
+    # 基础文件大小故意不是分块大小的整数倍
+    BASE = make_text(0, 1000)
+
+    @pytest.mark.parametrize('name, make_new', [
+        ('same', lambda base: base),
+        ('modify', lambda base: base[:9000] + b'CHANGED' + base[9007:]),
+        ('insert_start', lambda base: b'header\n' + base),
+        ('delete_middle', lambda base: base[:5000] + base[15000:]),
+        ('truncate', lambda base: base[:BLOCK_SIZE * 3 + 100]),
+        ('reorder', lambda base: base[BLOCK_SIZE * 10:] + base[:BLOCK_SIZE * 10]),
+        ('empty', lambda base: b''),
+        ('unrelated', lambda base: os.urandom(3000)),
+    ])
+    def test_rebuilds_identical_file(self, app, name, make_new):
+        assert len(self.BASE) % BLOCK_SIZE != 0
+        store_base(app, 'base.txt', self.BASE)
+        # 开启压缩时基础文件按gzip存储，重建需要先解压
+        expected_encoding = 'gzip' if app.config['STORAGE_COMPRESSION'] == 'gzip' else None
+        assert (app_module.get_stored_file_encoding('base.txt') or {}).get('encoding') == expected_encoding
+        new = make_new(self.BASE)
+        result, copied, append_only = reconstruct(app, 'base.txt', new, self.BASE)
+        assert result == new
+        assert append_only is (name == 'same')
+
+    def test_partial_last_block_copied_mid_file(self, app):
+        store_base(app, 'base.txt', self.BASE)
+        tail = self.BASE[(len(self.BASE) // BLOCK_SIZE) * BLOCK_SIZE:]
+        last_index = len(self.BASE) // BLOCK_SIZE
+        ops = [['copy', last_index, 1], ['data', 4], ['copy', 0, 1]]
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], '.result.tmp')
+        copied, append_only = app_module.reconstruct_from_delta(
+            'base.txt', BLOCK_SIZE, ops, io.BytesIO(b'XXXX'), tmp_path)
+        with open(tmp_path, 'rb') as f:
+            assert f.read() == tail + b'XXXX' + self.BASE[:BLOCK_SIZE]
+        assert copied == len(tail) + BLOCK_SIZE
+        assert append_only is False
+
+    def test_append_fast_path(self, app):
+        store_base(app, 'base.txt', self.BASE)
+        new = self.BASE + make_text(1000, 50)
+        ops, literal = build_delta(self.BASE, new)
+        assert ops[0] == ['copy', 0, (len(self.BASE) + BLOCK_SIZE - 1) // BLOCK_SIZE]
+        result, copied, append_only = reconstruct(app, 'base.txt', new, self.BASE)
+        assert append_only is True
+        assert copied == len(self.BASE)
+        assert result == new
+
+    def test_short_literal_raises(self, app):
+        store_base(app, 'base.txt', self.BASE)
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], '.result.tmp')
+        with pytest.raises(app_module.DeltaError):
+            app_module.reconstruct_from_delta(
+                'base.txt', BLOCK_SIZE, [['copy', 0, 1], ['data', 10]], io.BytesIO(b'short'), tmp_path)
+
+
+class TestApplyDeltaUpload:
+    BASE = make_text(0, 800)
+
+    def apply(self, app, version, new, size=None, extra_literal=b''):
+        ops, literal = build_delta(self.BASE, new)
+        return app_module.apply_delta_upload(
+            'doc.txt', 'admin', version, BLOCK_SIZE, ops,
+            len(new) if size is None else size, io.BytesIO(literal + extra_literal))
+
+    def leftover_temp_files(self, app):
+        return [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if name.startswith('.delta')]
+
+    def test_replaces_file(self, app):
+        version = store_base(app, 'doc.txt', self.BASE)
+        new = self.BASE[:7000] + b'edited' + self.BASE[7000:]
+        stats = self.apply(app, version, new)
+        assert read_logical(app, 'doc.txt') == new
+        # 只有被修改的块需要重新发送
+        assert stats['literal_bytes'] == BLOCK_SIZE + len(b'edited')
+        assert self.leftover_temp_files(app) == []
+
+    def test_stale_version_conflicts(self, app):
+        store_base(app, 'doc.txt', self.BASE)
+        with pytest.raises(app_module.DeltaConflict):
+            self.apply(app, '0:0', self.BASE + b'more')
+        assert read_logical(app, 'doc.txt') == self.BASE
+
+    @pytest.mark.parametrize('size_offset, extra_literal', [(1, b''), (-1, b''), (0, b'!')])
+    def test_size_mismatch_keeps_original(self, app, size_offset, extra_literal):
+        version = store_base(app, 'doc.txt', self.BASE)
+        new = self.BASE + make_text(800, 10)
+        with pytest.raises(app_module.DeltaError):
+            self.apply(app, version, new, size=len(new) + size_offset, extra_literal=extra_literal)
+        assert read_logical(app, 'doc.txt') == self.BASE
+        assert app_module.get_file_version(os.path.join(app.config['UPLOAD_FOLDER'], 'doc.txt')) == version
+        assert self.leftover_temp_files(app) == []
+
+
+class TestDeltaUploadRoute:
+    BASE = make_text(0, 300)
+
+    @pytest.fixture
+    def client(self, app):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'admin'
+        return client
+
+    def post_delta(self, client, new, version, size=None):
+        ops, literal = build_delta(self.BASE, new)
+        delta = {'filename': 'notes.txt', 'base_version': version, 'block_size': BLOCK_SIZE,
+                 'size': len(new) if size is None else size, 'ops': ops}
+        return client.post('/upload/delta', data={
+            'delta': app_module.json.dumps(delta),
+            'literal': (io.BytesIO(literal), 'literal')
+        }, content_type='multipart/form-data')
+
+    def test_signature_round_trip(self, app, client):
+        store_base(app, 'notes.txt', self.BASE)
+        signature = client.get('/files/notes.txt/signature').get_json()
+        assert signature['size'] == len(self.BASE)
+        new = self.BASE.replace(b'line 00150', b'LINE 00150')
+        response = self.post_delta(client, new, signature['version'])
+        assert response.status_code == 200
+        assert read_logical(app, 'notes.txt') == new
+
+    def test_conflict_returns_409(self, app, client):
+        store_base(app, 'notes.txt', self.BASE)
+        response = self.post_delta(client, self.BASE + b'x', '1:1')
+        assert response.status_code == 409
+
+    def test_size_mismatch_returns_400(self, app, client):
+        version = store_base(app, 'notes.txt', self.BASE)
+        response = self.post_delta(client, self.BASE + b'x', version, size=len(self.BASE) + 2)
+        assert response.status_code == 400
+        assert read_logical(app, 'notes.txt') == self.BASE
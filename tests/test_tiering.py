@@ -0,0 +1,66 @@
+"""分层存储测试：整理任务只把长期未访问的上传文件移到次级存储，剪贴板数据等内部文件始终留在本地。
+
+用法:
+    python -m pytest tests/test_tiering.py
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+# 导入时会创建默认应用，避免在项目目录下创建uploads
+os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp())
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app as app_module  # noqa: E402
+
+OLD_MTIME = 1_000_000_000
+
+
+@pytest.fixture
+def app(tmp_path):
+    flask_app = app_module.create_app({
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'TIER_LOCAL_DIR': str(tmp_path / 'cold'),
+        'TIERING_ENABLED': True,
+        'TIER_MIN_BYTES': 1024,
+        'TIER_COLD_AFTER_DAYS': 1,
+        'JOB_WORKERS': 0,
+        'TESTING': True,
+    })
+    with flask_app.app_context():
+        yield flask_app
+
+
+def make_old(path):
+    os.utime(path, (OLD_MTIME, OLD_MTIME))
+
+
+def test_sweep_keeps_clipboard_files(app):
+    app_module.save_clipboard_data({"clipboard_items": [
+        {"id": str(i), "content": "x" * 200, "created_at": "2020-01-01 00:00:00"} for i in range(20)
+    ]})
+    app_module.save_personal_clipboard_data({"personal_clipboards": [], "newlines_normalized": True, "padding": "x" * 4096})
+    make_old(app.config['CLIPBOARD_FILE'])
+    make_old(app.config['PERSONAL_CLIPBOARD_FILE'])
+    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], 'old.bin')
+    with open(upload_path, 'wb') as f:
+        f.write(os.urandom(4096))
+    make_old(upload_path)
+
+    result = app_module.tier_sweep_job(None, {})
+
+    assert result['moved'] == 1
+    assert not os.path.exists(upload_path)
+    assert len(app_module.load_clipboard_data()['clipboard_items']) == 20
+    assert app_module.load_personal_clipboard_data()['padding'] == "x" * 4096
+    assert app_module.get_tiering_report()['hot']['files'] == 0
+
+
+def test_demote_refuses_internal_files(app):
+    app_module.save_clipboard_data({"clipboard_items": [], "padding": "x" * 4096})
+    assert app_module.demote_file(os.path.basename(app.config['CLIPBOARD_FILE'])) is False
+    assert os.path.exists(app.config['CLIPBOARD_FILE'])